@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+# Benchmarks for draw-templates.py.
+# Copyright 2022 Jason Pepas.
+# Released under the terms of the MIT license.
+# See https://opensource.org/licenses/MIT
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import json
+import argparse
+import resource
+import subprocess
+import tracemalloc
+import importlib.util
+
+
+def load_templates():
+    # draw-templates.py isn't importable by name, so load it from its path.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "draw-templates.py")
+    spec = importlib.util.spec_from_file_location("draw_templates", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+t = load_templates()
+
+
+# Measurement:
+#
+# Every benchmark produces result dicts with the same keys, so they can
+# be printed, saved as JSON and compared against a previous run.  A
+# benchmark's memory is the peak of its Python allocations.  RSS is a
+# high-water mark for the whole process (and on Linux a child starts
+# with its parent's), so it is only reported once, for the whole run.
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024  # macOS reports bytes, Linux reports KB.
+    return peak
+
+def measure(benchmark, case, fn, rounds):
+    # Call fn() `rounds` times.  fn returns (ops, output bytes).  Python
+    # allocations are traced in one extra untimed call.
+    ops = 0
+    size = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        (n, size) = fn()
+        ops += n
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    peak_alloc = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "benchmark": benchmark,
+        "case": case,
+        "ops": ops,
+        "seconds": seconds,
+        "ops_per_sec": ops / seconds if seconds > 0 else float("inf"),
+        "bytes": size,
+        "peak_alloc_kb": peak_alloc // 1024,
+    }
+
+def print_result(r):
+    print("%-20s %-14s %8.1f ops/s %9s bytes %6s KB alloc"
+          % (r["benchmark"], r["case"], r["ops_per_sec"], r["bytes"], r["peak_alloc_kb"]), end="")
+    if "import_ms" in r:
+        print(" %6.1f ms imports" % r["import_ms"], end="")
+    print()
+
+def have_rsvg():
+    return shutil.which("rsvg-convert") is not None
+
+def can_run(backend):
+    # The SVG backends need rsvg-convert to make their PDFs.
+    return "svg" not in t.g_backends[backend].outputs or have_rsvg()
+
+
+# Stages:
+#
+# Each case goes through every stage on its own: layout, part geometry,
+# drawing onto page objects, building the drawSvg elements, serialising
+# the SVG, serialising it compactly instead, drawing and writing with
+# the streaming SVG writer instead, rsvg-convert from a file and through
+# a pipe, the direct PDF backend and optimising the cutter tool paths.
+
+def draw_pages(case, backend):
+    # Draw every page of a case without rendering it.
+    canvas = t.Canvas(backend)
+    layout = t.g_layouts[t.g_layout](t.case_parts(case))
+    return [t.draw_page(canvas, case, i + 1, placements) for (i, placements) in enumerate(layout)]
+
+def bench_stages(rounds=5):
+    results = []
+    for case in t.g_cases:
+        layout = t.g_layouts[t.g_layout](t.case_parts(case))
+        svg_pages = draw_pages(case, t.SvgPage)
+        drawings = [page.get_drawing() for page in svg_pages]
+        svgs = [drawing.asSvg().encode("utf-8") for drawing in drawings]
+        pdf_pages = draw_pages(case, t.PdfPage)
+        cutter_pages = draw_pages(case, t.HpglPage)
+        compact_pages = draw_pages(case, t.CompactSvgPage)
+
+        def layout_parts():
+            t.g_layouts[t.g_layout](t.case_parts(case))
+            return (1, 0)
+
+        def geometry():
+            placed = [t.place_outlines(placement) for placements in layout for placement in placements]
+            return (len(placed), sum(points.nbytes for outlines in placed for points in outlines))
+
+        def draw():
+            return (len(draw_pages(case, t.SvgPage)), 0)
+
+        def svg_build():
+            return (len([page.get_drawing() for page in svg_pages]), 0)
+
+        def svg_serialise():
+            data = [drawing.asSvg().encode("utf-8") for drawing in drawings]
+            return (len(data), sum(len(d) for d in data))
+
+        def svg_compact():
+            data = [page.svg().encode("utf-8") for page in compact_pages]
+            return (len(data), sum(len(d) for d in data))
+
+        def svg_stream():
+            size = 0
+            for page in draw_pages(case, t.StreamingSvgPage):
+                path = page.finish()
+                size += os.path.getsize(path)
+                os.remove(path)
+            return (len(svgs), size)
+
+        def rsvg_convert():
+            size = 0
+            for svg in svgs:
+                with open("bench.svg", "wb") as f:
+                    f.write(svg)
+                subprocess.check_call(t.rsvg_command(["bench.svg"], "bench.pdf"))
+                size += os.path.getsize("bench.pdf")
+            return (len(svgs), size)
+
+        def rsvg_pipe():
+            size = 0
+            for svg in svgs:
+                size += len(subprocess.run(t.rsvg_command(), input=svg, stdout=subprocess.PIPE, check=True).stdout)
+            return (len(svgs), size)
+
+        def pdf_direct():
+            size = 0
+            for page in pdf_pages:
+                page.render("bench")
+                size += os.path.getsize("bench.pdf")
+            return (len(pdf_pages), size)
+
+        def tool_paths():
+            return (len([page.tool_paths() for page in cutter_pages]), 0)
+
+        stages = [
+            ("layout", layout_parts),
+            ("geometry", geometry),
+            ("draw", draw),
+            ("svg-build", svg_build),
+            ("svg-serialise", svg_serialise),
+            ("svg-compact", svg_compact),
+            ("svg-stream", svg_stream),
+            ("rsvg-convert", rsvg_convert),
+            ("rsvg-pipe", rsvg_pipe),
+            ("pdf-direct", pdf_direct),
+            ("tool-paths", tool_paths),
+        ]
+        for (stage, fn) in stages:
+            if stage.startswith("rsvg-") and not have_rsvg():
+                continue
+            results.append(measure(stage, case, fn, rounds))
+    return results
+
+
+# Backends:
+
+def bench_backends(rounds=5):
+    # Render every case end to end with each backend.  The SVG backends
+    # are run again converting each page before drawing the next, to
+    # show what the conversion pipeline saves.
+    results = []
+    t.g_cache_dir = None
+    for backend in sorted(t.g_backends):
+        if not can_run(backend):
+            continue
+        for convert_jobs in (None, 0):
+            if convert_jobs == 0 and "svg" not in t.g_backends[backend].outputs:
+                continue
+
+            def render_all():
+                t.g_backend = backend
+                t.g_convert_jobs = convert_jobs
+                return (sum(t.draw_case(case) for case in t.g_cases), 0)
+
+            label = "backend-" + backend + ("-inline" if convert_jobs == 0 else "")
+            results.append(measure(label, "all", render_all, rounds))
+    t.g_convert_jobs = None
+    return results
+
+
+# Concurrency:
+
+def bench_threads(rounds=5, jobs=4):
+    # Render rounds x every case sequentially, then concurrently in a
+    # thread pool in this same interpreter.
+    results = []
+    t.g_cache_dir = None
+    cases = list(t.g_cases) * rounds
+    for backend in sorted(t.g_backends):
+        if not can_run(backend):
+            continue
+        t.g_backend = backend
+        for (label, threads) in (("sequential", False), ("threads", True)):
+
+            def render_all():
+                if threads:
+                    done = t.draw_cases(cases, jobs, threads=True)
+                else:
+                    done = [t.draw_case_timed(case) for case in cases]
+                return (sum(result[1] for result in done), 0)
+
+            results.append(measure("%s-%s" % (label, backend), "all", render_all, 1))
+    return results
+
+
+# Start-up:
+#
+# Commands which don't draw anything should answer in milliseconds, so
+# run them in a fresh interpreter each round.  The time spent importing
+# modules, from python -X importtime, is saved with the results.
+
+g_startup_commands = (
+    ("list", ["--list"]),
+    ("bounds", ["--bounds", "--all"]),
+    ("dry-run", ["--dry-run", "--all"]),
+)
+
+def import_time_ms(argv):
+    # Sum the cumulative time of every top-level import.
+    cmd = [sys.executable, "-X", "importtime", t.__file__] + argv
+    stderr = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True).stderr
+    total_us = 0
+    for line in stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            if not fields[2].startswith("  "):  # Nested imports are indented further.
+                total_us += int(fields[1])
+    return total_us / 1000
+
+def bench_startup(rounds=5):
+    results = []
+    for (label, argv) in g_startup_commands:
+
+        def run():
+            cmd = [sys.executable, t.__file__] + argv
+            return (1, len(subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout))
+
+        r = measure("startup-" + label, "all", run, rounds)
+        r["import_ms"] = import_time_ms(argv)
+        results.append(r)
+    return results
+
+
+# Regressions:
+
+def compare(results, baseline, threshold):
+    # Return the results whose ops/sec dropped by more than `threshold`
+    # (a fraction) compared with the same benchmark and case in baseline.
+    before = dict(((r["benchmark"], r["case"]), r) for r in baseline)
+    slower = []
+    for r in results:
+        old = before.get((r["benchmark"], r["case"]))
+        if old is not None and r["ops_per_sec"] < old["ops_per_sec"] * (1 - threshold):
+            slower.append((r, old))
+    return slower
+
+
+# Main:
+
+g_suites = {
+    "stages": bench_stages,
+    "backends": bench_backends,
+    "threads": bench_threads,
+    "startup": bench_startup,
+}
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark draw-templates.py.")
+    parser.add_argument(
+        "rounds", nargs="?", type=int, default=5,
+        help="how many times to repeat each benchmark (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--suite", action="append", choices=sorted(g_suites),
+        help="which benchmarks to run, may be repeated (default: all)"
+    )
+    parser.add_argument(
+        "--json", metavar="FILE",
+        help="write the results to FILE as JSON"
+    )
+    parser.add_argument(
+        "--compare", metavar="FILE",
+        help="compare against results saved with --json, exit 1 on a regression"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.2,
+        help="how much slower counts as a regression (default: %(default)s)"
+    )
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    suites = args.suite or list(g_suites)
+    # Resolve paths before moving into the scratch dir.
+    json_path = os.path.abspath(args.json) if args.json else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    if not have_rsvg():
+        print("rsvg-convert not found, skipping rsvg benchmarks")
+
+    results = []
+    # Rendering writes to the current directory, so work in a scratch dir.
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        for suite in suites:
+            for r in g_suites[suite](args.rounds):
+                print_result(r)
+                results.append(r)
+
+    peak_rss = {"self": peak_rss_kb(), "children": peak_rss_kb(resource.RUSAGE_CHILDREN)}
+    print("Peak RSS: %s KB, %s KB in child processes" % (peak_rss["self"], peak_rss["children"]))
+
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump({"python": sys.version.split()[0], "peak_rss_kb": peak_rss, "results": results}, f, indent=1)
+
+    if compare_path is not None:
+        with open(compare_path) as f:
+            baseline = json.load(f)["results"]
+        slower = compare(results, baseline, args.threshold)
+        for (r, old) in slower:
+            print("REGRESSION %s %s: %.1f -> %.1f ops/s"
+                  % (r["benchmark"], r["case"], old["ops_per_sec"], r["ops_per_sec"]))
+        if len(slower) > 0:
+            sys.exit(1)
@@ -7,25 +7,74 @@
 
 import sys
 import subprocess
+import argparse
+import time
+import os
+import hashlib
+import shutil
+import tempfile
+import csv
+import json
+import bisect
+import collections
+import collections.abc
+import threading
+import base64
+import socketserver
+import stat
+import signal
+import importlib.util
+import math
+import re
+import contextlib
+import atexit
+from typing import NamedTuple
+
+
+def lazy_import(name):
+    # Return a module which is only really imported when one of its
+    # attributes is first used, so commands which don't draw anything
+    # (--list, --bounds, --dry-run) don't pay for loading it.
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named %r" % name, name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# Only needed for rendering several cases, writing SVG text or .svgz, or
+# profiling.
+multiprocessing = lazy_import("multiprocessing")
+futures = lazy_import("concurrent.futures")
+saxutils = lazy_import("xml.sax.saxutils")
+gzip = lazy_import("gzip")
+cProfile = lazy_import("cProfile")
 
 # This uses drawSvg, see https://github.com/cduck/drawSvg
 # brew install cairo
 # pip3 install drawSvg
-import drawSvg
+# Importing it loads cairo, which takes most of our start-up time.
+drawSvg = lazy_import("drawSvg")
+
+# NumPy is installed along with drawSvg.  Layout and bounds only need
+# plain floats; NumPy is loaded once outlines are drawn.
+np = lazy_import("numpy")
+
+def load_lazy_modules():
+    # LazyLoader isn't thread-safe before Python 3.12: a thread can see a
+    # module half loaded while another is loading it.  Load them all
+    # before starting threads which draw.
+    for module in (saxutils, gzip, drawSvg, np):
+        module.__name__
 
 
 # Global config:
 
-g_cases = {
-    # Tuple format: (name, top_len, top_width, bottom_len, bottom_width, height, notch)
-    "1590B": ("Hammond 1590B", 112.4, 60.5, 110.7, 58.7, 31.1, 10),
-    "1590B-tayda": ("Hammond 1590B (Tayda clone)", 112.4, 60.4, 110.4, 58.7, 31.1, 10),
-    "1590BB": ("Hammond 1590BB", 119.9, 94.3, 117.0, 91.5, 34.1, 10),
-    "1590BB-tayda": ("Hammond 1590BB (Tayda clone)", 120.2, 95.0, 118.9, 93.7, 37.3, 10),
-    "1590Y": ("Hammond 1590Y", 92.2, 92.2, 90.0, 90.0, 41.8, 10),
-    "1550P": ("Hammond 1550P", 80.2, 55.0, 79.4, 54.4, 25.4, 10),
-    "1590A-tayda": ("Hammond 1590A (Tayda clone)", 92.4, 38.3, 91.4, 37.3, 31.1, 10),
-}
+# The enclosures we know about, see cases.csv and Catalog below.
+g_catalog_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cases.csv")
 
 g_foam_thick = 6  # "Hobby EVA foam" on Amazon.com is 6mm thick.
 
@@ -34,6 +83,112 @@ g_fudge = 1.0  # Global correction scaling factor.
 # g_fudge = 1.0045  # Correction factor if you printer is lame like mine.
 
 
+# Case catalog:
+#
+# Cases are loaded from a CSV or JSON file with one record per case:
+# id, desc, top_len, top_width, bottom_len, bottom_width, height, notch.
+# A JSON catalog is a list of objects with those keys.
+
+class Case(NamedTuple):
+    desc: str
+    top_len: float
+    top_width: float
+    bottom_len: float
+    bottom_width: float
+    height: float
+    notch: float
+
+g_case_dimensions = Case._fields[1:]
+
+def parse_case(record, where):
+    # Build a Case from a dict of strings (or numbers), checking that the
+    # dimensions make sense.  `where` prefixes error messages.
+    if not isinstance(record, dict):
+        raise ValueError("%s: expected an object with the case's fields" % where)
+    missing = [field for field in ("id",) + Case._fields if record.get(field) in (None, "")]
+    if len(missing) > 0:
+        raise ValueError("%s: missing %s" % (where, ", ".join(missing)))
+    try:
+        dims = [float(record[field]) for field in g_case_dimensions]
+    except (TypeError, ValueError):
+        raise ValueError("%s: dimensions must be numbers" % where)
+    case = Case(str(record["desc"]), *dims)
+    if min(dims) <= 0:
+        raise ValueError("%s: dimensions must be positive" % where)
+    if case.bottom_len > case.top_len or case.bottom_width > case.top_width:
+        raise ValueError("%s: the bottom can't be bigger than the top" % where)
+    if case.notch * 2 >= min(case.top_len, case.top_width):
+        raise ValueError("%s: the notches don't fit on the top" % where)
+    return (str(record["id"]), case)
+
+def read_catalog(path):
+    # Returns an ordered dict of id -> Case.
+    if path.endswith(".json"):
+        with open(path) as f:
+            records = json.load(f)
+        if not isinstance(records, list):
+            raise ValueError("%s: expected a list of cases" % path)
+        records = [(record, "%s: record %s" % (path, i + 1)) for (i, record) in enumerate(records)]
+    else:
+        with open(path, newline="") as f:
+            lines = [(i + 1, line) for (i, line) in enumerate(f) if not line.startswith("#") and line.strip()]
+        reader = csv.DictReader(line for (_, line) in lines)
+        records = [(record, "%s:%s" % (path, lines[i + 1][0])) for (i, record) in enumerate(reader)]
+    cases = {}
+    for (record, where) in records:
+        (case_id, case) = parse_case(record, where)
+        if case_id in cases:
+            raise ValueError("%s: duplicate case %s" % (where, case_id))
+        cases[case_id] = case
+    return cases
+
+class Catalog(collections.abc.Mapping):
+    # A read-only dict of case id -> Case, loaded from `path` on first use.
+    # Range queries on the dimensions use per-field sorted indexes, which
+    # are also built on first use.
+
+    def __init__(self, path):
+        self.path = path
+        self.cases = None
+        self.indexes = {}
+
+    def load(self):
+        if self.cases is None:
+            self.cases = read_catalog(self.path)
+        return self.cases
+
+    def __getitem__(self, case_id):
+        return self.load()[case_id]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def index(self, field):
+        if field not in self.indexes:
+            self.indexes[field] = sorted((getattr(case, field), case_id) for (case_id, case) in self.load().items())
+        return self.indexes[field]
+
+    def query(self, **ranges):
+        # Case ids, in catalog order, with every given dimension inside
+        # its (min, max) range.  Either end may be None.
+        #   g_cases.query(height=(None, 35), top_len=(100, None))
+        matches = None
+        for (field, (low, high)) in ranges.items():
+            if field not in g_case_dimensions:
+                raise ValueError("unknown dimension %s (choose from %s)" % (field, ", ".join(g_case_dimensions)))
+            index = self.index(field)
+            start = 0 if low is None else bisect.bisect_left(index, (low,))
+            end = len(index) if high is None else bisect.bisect_right(index, (high, chr(0x10ffff)))
+            found = set(case_id for (_, case_id) in index[start:end])
+            matches = found if matches is None else matches & found
+        return [case_id for case_id in self.load() if matches is None or case_id in matches]
+
+g_cases = Catalog(g_catalog_path)
+
+
 # Unit conversions:
 
 def in_to_mm(inches):
@@ -48,15 +203,15 @@ def in_to_px(inches):
 def mm_to_px(mm):
     return in_to_px(mm_to_in(mm))
 
-# Global state:
-g_size_mm = (in_to_mm(7.5), in_to_mm(10))
-g_position_mm = (0, 0)
-g_pen_is_down = False
+def mm_to_pt(mm):
+    return mm_to_in(mm) * 72 * g_fudge
 
-g_drawing = drawSvg.Drawing(
-    mm_to_px(g_size_mm[0]),
-    mm_to_px(g_size_mm[1])
-)
+# These also work element-wise on NumPy arrays.
+
+g_size_mm = (in_to_mm(7.5), in_to_mm(10))
+g_coalesce = True  # Draw each pen_down() ... pen_up() as a single path.
+g_combine = False  # Write one multi-page PDF per case instead of one per page.
+g_backend = "rsvg"  # See g_backends below.
 
 
 # Coordinate translation:
@@ -70,82 +225,148 @@ def flip_dy(dy):
 def bottom():
     return g_size_mm[1]
 
+def page_to_px(points):
+    # (N, 2) array of page mm (y down) -> drawSvg px (y up).
+    return np.column_stack((mm_to_px(points[:, 0]), mm_to_px(flip_y(points[:, 1]))))
 
-# Low-level drawing functions:
+def page_to_pt(points):
+    # (N, 2) array of page mm (y down) -> PDF points (y up).
+    return np.column_stack((mm_to_pt(points[:, 0]), mm_to_pt(flip_y(points[:, 1]))))
 
-def pen_down():
-    global g_pen_is_down
-    g_pen_is_down = True
-
-def pen_up():
-    global g_pen_is_down
-    g_pen_is_down = False
-
-def move(dx, dy):
-    global g_pen_is_down
-    global g_position_mm
-    if g_pen_is_down:
-        draw_line(g_position_mm[0], g_position_mm[1], dx, dy)
-    g_position_mm = (g_position_mm[0] + dx, g_position_mm[1] + dy)
-
-def warp(x, y):
-    global g_position_mm
-    g_position_mm = (x, y)
-
-def text(content, align_right=False):
-    font_size = 12
-    if align_right:
-        g_drawing.append(
-            drawSvg.Text(
-                content,
-                font_size * g_dpi / 72 * g_fudge,
-                mm_to_px(g_position_mm[0]),
-                mm_to_px(flip_y(g_position_mm[1])),
-                text_anchor="end"
-            )
-        )
-    else:
-        g_drawing.append(
-            drawSvg.Text(
-                content,
-                font_size * g_dpi / 72 * g_fudge,
-                mm_to_px(g_position_mm[0]),
-                mm_to_px(flip_y(g_position_mm[1]))
-            )
-        )
+def page_to_mm(points):
+    # (N, 2) array of page mm (y down) -> cutter mm (y up).
+    return np.column_stack((points[:, 0], flip_y(points[:, 1])))
 
-# High-level drawing functions:
+def transform_paths(paths, to_page):
+    # Transform a list of (N, 2) arrays with a single array operation.
+    if len(paths) == 0:
+        return []
+    points = to_page(np.concatenate(paths))
+    return np.split(points, np.cumsum([len(path) for path in paths])[:-1])
 
-def draw_line(origin_x, origin_y, dx, dy):
-    g_drawing.append(
-        drawSvg.Line(
-            mm_to_px(origin_x),
-            mm_to_px(flip_y(origin_y)),
-            mm_to_px(origin_x + dx),
-            mm_to_px(flip_y(origin_y) + flip_dy(dy)),
-            stroke='black',
-            stroke_width=2,
-            fill='none'
-        )
-    )
 
-def draw_box(w, h):
-    pen_down()
-    move(w, 0)
-    move(0, h)
-    move(-w, 0)
-    move(0, -h)
-    pen_up()
-
-def draw_ruler():
-    warp(5, bottom() - 12)
-    text("14cm Ruler")
-    warp(5 + 140, bottom() - 12)
-    text("github.com/hammond-foam", align_right=True)
-    warp(5, bottom() - 10)
+# Low-level drawing functions:
+#
+# A Canvas is a turtle: it holds the pen position and state and the page
+# being drawn on.  All drawing goes through a Canvas (rather than module
+# globals), so several templates can be drawn at once in threads.
+
+class Canvas:
+    def __init__(self, backend=None, coalesce=None, combine=None):
+        if backend is None:
+            backend = g_backends[g_backend]
+        if coalesce is None:
+            coalesce = g_coalesce
+        if combine is None:
+            combine = g_combine
+        self.backend = backend  # A page class, see g_backends.
+        self.coalesce = coalesce  # Draw each pen_down() ... pen_up() as a single path.
+        self.combine = combine  # Render all of a layout's pages into one PDF.
+        self.position_mm = (0, 0)
+        self.pen_is_down = False
+        self.path_mm = None  # Points of the outline being drawn, see pen_down().
+        self.drawing = None  # The current page, see start_drawing().
+        self.out_dir = ""  # Where rendered pages are written.
+        self.rendered = []  # The basenames of the pages rendered so far.
+        self.pending = []  # Conversions still running, see Converter.
+        self.cache_hits = 0
+        self.paths_drawn = 0
+
+    def pen_down(self):
+        self.pen_is_down = True
+        if self.coalesce:
+            self.start_path()
+
+    def pen_up(self):
+        self.end_path()
+        self.pen_is_down = False
+
+    def move(self, dx, dy):
+        if self.pen_is_down and self.path_mm is None:
+            self.draw_line(self.position_mm[0], self.position_mm[1], dx, dy)
+        self.position_mm = (self.position_mm[0] + dx, self.position_mm[1] + dy)
+        if self.pen_is_down and self.path_mm is not None:
+            self.path_mm.append(self.position_mm)
+
+    def warp(self, x, y):
+        self.end_path()
+        self.position_mm = (x, y)
+        if self.pen_is_down and self.coalesce:
+            self.start_path()
+
+    def start_path(self):
+        self.end_path()
+        self.path_mm = [self.position_mm]
+
+    def end_path(self):
+        if self.path_mm is not None and len(self.path_mm) > 1:
+            self.draw_path(np.array(self.path_mm, dtype=float))
+        self.path_mm = None
+
+    def text(self, content, align_right=False):
+        self.drawing.text(content, self.position_mm[0], self.position_mm[1], align_right)
+
+    def draw_line(self, origin_x, origin_y, dx, dy):
+        points = np.array([(origin_x, origin_y), (origin_x + dx, origin_y + dy)], dtype=float)
+        self.add_path(points, False)
+
+    def draw_path(self, points):
+        # A path which ends where it started is drawn closed ("Z").
+        closed = len(points) > 2 and is_same_point(points[0], points[-1])
+        if closed:
+            points = points[:-1]
+        self.add_path(points, closed)
+
+    def draw_outlines(self, outlines):
+        # Draw closed outlines, (N, 2) arrays in page mm.
+        for points in outlines:
+            if self.coalesce:
+                self.add_path(points, True)
+            else:
+                for i in range(len(points)):
+                    self.add_path(points[[i - 1, i]], False)
+
+    def add_path(self, points, closed):
+        self.paths_drawn += 1
+        self.drawing.path(points, closed)
+
+def is_same_point(a, b):
+    return abs(a[0] - b[0]) < 1e-9 and abs(a[1] - b[1]) < 1e-9
+
+# High-level drawing functions:
+
+def draw_box(canvas, w, h):
+    canvas.pen_down()
+    canvas.move(w, 0)
+    canvas.move(0, h)
+    canvas.move(-w, 0)
+    canvas.move(0, -h)
+    canvas.pen_up()
+
+def draw_ruler(canvas):
+    canvas.warp(5, bottom() - 12)
+    canvas.text("14cm Ruler")
+    canvas.warp(5 + 140, bottom() - 12)
+    canvas.text("github.com/hammond-foam", align_right=True)
+    canvas.warp(5, bottom() - 10)
     for _ in range(14):
-        draw_box(10, 5)
-        move(10, 0)
+        draw_box(canvas, 10, 5)
+        canvas.move(10, 0)
+
+
+# Part outlines:
+#
+# Each part is a list of closed outlines, (N, 2) arrays of mm relative to
+# the top left of the part's bounds.
+
+def outline(start, moves):
+    # A closed outline from its start point and the relative moves around
+    # it, which end back at the start.
+    points = np.cumsum(np.array([start] + moves, dtype=float), axis=0)
+    return points[:-1]
+
+def draw_outlines_at(canvas, x, y, outlines):
+    canvas.draw_outlines([points + (x, y) for points in outlines])
 
 
 # Top:
@@ -156,24 +377,25 @@ def get_top_bounds_h(case):
     h = top_width + g_foam_thick * 2
     return (w, h)
 
-def draw_top_h(x, y, case):
+def get_top_outlines_h(case):
     (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
-    warp(x, y)
-    move(g_foam_thick + notch, 0)
-    pen_down()
-    move(top_len - notch - notch, 0)
-    move(0, g_foam_thick + notch)
-    move(g_foam_thick + notch, 0)
-    move(0, top_width - notch - notch)
-    move(-(g_foam_thick + notch), 0)
-    move(0, g_foam_thick + notch)
-    move(-(top_len - notch - notch), 0)
-    move(0, -(g_foam_thick + notch))
-    move(-(g_foam_thick + notch), 0)
-    move(0, -(top_width - notch - notch))
-    move(g_foam_thick + notch, 0)
-    move(0, -(g_foam_thick + notch))
-    pen_up()
+    return [outline((g_foam_thick + notch, 0), [
+        (top_len - notch - notch, 0),
+        (0, g_foam_thick + notch),
+        (g_foam_thick + notch, 0),
+        (0, top_width - notch - notch),
+        (-(g_foam_thick + notch), 0),
+        (0, g_foam_thick + notch),
+        (-(top_len - notch - notch), 0),
+        (0, -(g_foam_thick + notch)),
+        (-(g_foam_thick + notch), 0),
+        (0, -(top_width - notch - notch)),
+        (g_foam_thick + notch, 0),
+        (0, -(g_foam_thick + notch)),
+    ])]
+
+def draw_top_h(canvas, x, y, case):
+    draw_outlines_at(canvas, x, y, get_top_outlines_h(case))
 
 
 # End caps:
@@ -184,15 +406,17 @@ def get_end_bounds_h(case):
     h = height
     return (w, h)
 
-def draw_end_h(x, y, case):
+def get_end_outlines_h(case):
     (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
-    warp(x, y)
-    pen_down()
-    move(top_width + g_foam_thick * 2, 0)
-    move(-((top_width - bottom_width) / 2), height)
-    move(-(bottom_width + g_foam_thick * 2), 0)
-    move(-((top_width - bottom_width) / 2), -height)
-    pen_up()
+    return [outline((0, 0), [
+        (top_width + g_foam_thick * 2, 0),
+        (-((top_width - bottom_width) / 2), height),
+        (-(bottom_width + g_foam_thick * 2), 0),
+        (-((top_width - bottom_width) / 2), -height),
+    ])]
+
+def draw_end_h(canvas, x, y, case):
+    draw_outlines_at(canvas, x, y, get_end_outlines_h(case))
 
 
 # Sides:
@@ -203,121 +427,2848 @@ def get_side_bounds_h(case):
     h = height
     return (w, h)
 
-def draw_side_h(x, y, case):
+def get_side_outlines_h(case):
     (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
-    warp(x, y)
-    pen_down()
-    move(top_len + g_foam_thick * 2, 0)
-    move(-((top_len - bottom_len) / 2), height)
-    move(-(bottom_len + g_foam_thick * 2), 0)
-    move(-((top_len - bottom_len) / 2), -height)
-    pen_up()
+    return [outline((0, 0), [
+        (top_len + g_foam_thick * 2, 0),
+        (-((top_len - bottom_len) / 2), height),
+        (-(bottom_len + g_foam_thick * 2), 0),
+        (-((top_len - bottom_len) / 2), -height),
+    ])]
+
+def draw_side_h(canvas, x, y, case):
+    draw_outlines_at(canvas, x, y, get_side_outlines_h(case))
 
 
 # Bottom:
 
+g_cutout_margin = 6  # The center cutout's inside margin, on top of g_foam_thick.
+
 def get_bottom_bounds_h(case):
     (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
     w = bottom_len + g_foam_thick * 2
     h = bottom_width + g_foam_thick * 2
     return (w, h)
 
-def draw_bottom_h(x, y, case, center_cutout=False):
+def get_bottom_outlines_h(case, center_cutout=False):
     (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
-    warp(x, y)
-    pen_down()
-    move(bottom_len + g_foam_thick * 2, 0)
-    move(0, bottom_width + g_foam_thick * 2)
-    move(-(bottom_len + g_foam_thick * 2), 0)
-    move(0, -(bottom_width + g_foam_thick * 2))
+    outlines = [outline((0, 0), [
+        (bottom_len + g_foam_thick * 2, 0),
+        (0, bottom_width + g_foam_thick * 2),
+        (-(bottom_len + g_foam_thick * 2), 0),
+        (0, -(bottom_width + g_foam_thick * 2)),
+    ])]
     if center_cutout:
-        margin = 6  # additional inside margin
-        warp(x + g_foam_thick + margin, y + g_foam_thick + margin)
-        move(bottom_len - margin * 2, 0)
-        move(0, bottom_width - margin * 2)
-        move(-(bottom_len - margin * 2), 0)
-        move(0, -(bottom_width - margin * 2))
-    pen_up()
+        margin = g_cutout_margin
+        outlines.append(outline((g_foam_thick + margin, g_foam_thick + margin), [
+            (bottom_len - margin * 2, 0),
+            (0, bottom_width - margin * 2),
+            (-(bottom_len - margin * 2), 0),
+            (0, -(bottom_width - margin * 2)),
+        ]))
+    return outlines
+
+def get_bottom_cutout_outlines_h(case):
+    return get_bottom_outlines_h(case, center_cutout=True)
+
+def get_bottom_cutout_holes_h(case):
+    (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
+    margin = g_cutout_margin
+    return [(g_foam_thick + margin, g_foam_thick + margin, bottom_len - margin * 2, bottom_width - margin * 2)]
 
+def draw_bottom_h(canvas, x, y, case, center_cutout=False):
+    draw_outlines_at(canvas, x, y, get_bottom_outlines_h(case, center_cutout))
 
-# Rendering to pages:
+def draw_bottom_cutout_h(canvas, x, y, case):
+    draw_bottom_h(canvas, x, y, case, center_cutout=True)
+
+
+# Parts:
+#
+# A part is a (kind, case) tuple naming one foam piece.
+
+g_part_kinds = {
+    # kind: (bounds function, outlines function)
+    "top": (get_top_bounds_h, get_top_outlines_h),
+    "end": (get_end_bounds_h, get_end_outlines_h),
+    "side": (get_side_bounds_h, get_side_outlines_h),
+    "bottom_cutout": (get_bottom_bounds_h, get_bottom_cutout_outlines_h),
+    "bottom": (get_bottom_bounds_h, get_bottom_outlines_h),
+}
+
+g_part_holes = {
+    # kind: holes function, returning the (x, y, w, h) rectangles cut out
+    # of the part, relative to the top left of its bounds.
+    "bottom_cutout": get_bottom_cutout_holes_h,
+}
+
+def case_parts(case):
+    # The foam pieces needed to wrap one case, in drawing order.
+    return [
+        ("top", case),
+        ("end", case), ("end", case),
+        ("side", case), ("side", case),
+        ("bottom_cutout", case), ("bottom_cutout", case),
+        ("bottom", case),
+    ]
+
+def get_part_bounds(part):
+    return g_geometry.get(part, "bounds")
+
+def get_part_outlines(part):
+    return g_geometry.get(part, "outlines")
+
+def get_part_holes(part):
+    return g_geometry.get(part, "holes")
+
+
+# Geometry cache:
+#
+# Layout asks for the same parts' bounds over and over, so each part's
+# bounds and outlines are computed once and kept, keyed on what they
+# depend on: the kind of part, the case's dimensions (not its id or
+# description, so clones with the same dimensions share an entry) and
+# the foam thickness.  Bounds ((w, h) tuples), holes (tuples of (x, y,
+# w, h) tuples) and outlines (tuples of read-only (N, 2) arrays) are
+# separate entries, so that laying parts out never needs NumPy.
+
+class GeometryCache:
+    # A least recently used cache of part bounds and outlines, with
+    # hit/miss counts.
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, part, what):
+        # what is "bounds", "holes" or "outlines".
+        (kind, case) = part
+        key = (what, kind, g_cases[case][1:], g_foam_thick)
+        with self.lock:
+            geometry = self.entries.get(key)
+            if geometry is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return geometry
+            self.misses += 1
+        (bounds_fn, outlines_fn) = g_part_kinds[kind]
+        if what == "bounds":
+            geometry = bounds_fn(case)
+        elif what == "holes":
+            geometry = tuple(g_part_holes[kind](case)) if kind in g_part_holes else ()
+        else:
+            geometry = tuple(outlines_fn(case))
+            for points in geometry:
+                points.flags.writeable = False
+        with self.lock:
+            self.entries[key] = geometry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return geometry
+
+    def stats(self):
+        return "%s hits, %s misses, %s entries" % (self.hits, self.misses, len(self.entries))
+
+g_geometry = GeometryCache(1024)
+
+def place_outlines(placement):
+    # The part's outlines in page mm.  A rotated part is turned by 90
+    # degrees: the part-local point (u, v) lands at (x + v, y + w - u).
+    (part, x, y, rotated) = placement
+    outlines = get_part_outlines(part)
+    if rotated:
+        w = get_part_bounds(part)[0]
+        return [np.column_stack((x + points[:, 1], y + w - points[:, 0])) for points in outlines]
+    return [points + (x, y) for points in outlines]
+
+def draw_part(canvas, placement):
+    canvas.draw_outlines(place_outlines(placement))
+
+
+# Page layout:
+#
+# A layout is a list of pages, each a list of placements, where a
+# placement is a (part, x, y, rotated) tuple in page mm.  Parts go
+# between the title and the ruler, g_gap apart.
+
+g_gap = 5
+g_layout = "pack"  # See g_layouts below.
+g_nest = True  # Nest parts in the cutouts of other parts, see nest_in_holes().
+g_common_line = False  # Pack parts edge to edge and cut shared edges once, see merge_common_lines().
+
+def part_gap():
+    # The gap the pack layout leaves between parts.  With common lines
+    # parts abut, so the edges they share can be cut once.
+    return 0 if g_common_line else g_gap
+
+def layout_area():
+    # (x, y, w, h) of the page area available to parts.
+    (x, y) = (5, 15)
+    return (x, y, g_size_mm[0] - 2 * x, bottom() - 20 - y)
+
+def stack_parts(parts):
+    # One column down the left of the page, starting a new page whenever
+    # the next part doesn't fit.
+    (area_x, area_y, area_w, area_h) = layout_area()
+    pages = [[]]
+    y = area_y
+    for part in parts:
+        (w, h) = get_part_bounds(part)
+        if len(pages[-1]) > 0 and y + h >= area_y + area_h:
+            pages.append([])
+            y = area_y
+        pages[-1].append((part, area_x, y, False))
+        y += h + g_gap
+    return pages
+
+class MaxRectsBin:
+    # The free space on one page as a list of maximal free rectangles,
+    # see Jukka Jylanki, "A Thousand Ways to Pack the Bin" (2010).
+
+    def __init__(self, w, h):
+        self.free = [(0, 0, w, h)]
+
+    def find(self, w, h):
+        # Best short side fit, returns (score, x, y, rotated) or None.
+        best = None
+        for (fx, fy, fw, fh) in self.free:
+            for (pw, ph, rotated) in ((w, h, False), (h, w, True)):
+                if pw <= fw + 1e-9 and ph <= fh + 1e-9:
+                    score = (min(fw - pw, fh - ph), max(fw - pw, fh - ph))
+                    if best is None or score < best[0]:
+                        best = (score, fx, fy, rotated)
+        return best
+
+    def insert(self, x, y, w, h):
+        free = []
+        for rect in self.free:
+            free.extend(split_free_rect(rect, (x, y, w, h)))
+        # Drop free rectangles which are contained in another one.
+        self.free = [
+            a for (i, a) in enumerate(free)
+            if not any(j != i and rect_contains(b, a) and (b != a or j < i) for (j, b) in enumerate(free))
+        ]
+
+def split_free_rect(free, used):
+    (fx, fy, fw, fh) = free
+    (ux, uy, uw, uh) = used
+    if ux >= fx + fw or ux + uw <= fx or uy >= fy + fh or uy + uh <= fy:
+        return [free]
+    rects = []
+    if ux > fx:
+        rects.append((fx, fy, ux - fx, fh))
+    if ux + uw < fx + fw:
+        rects.append((ux + uw, fy, fx + fw - (ux + uw), fh))
+    if uy > fy:
+        rects.append((fx, fy, fw, uy - fy))
+    if uy + uh < fy + fh:
+        rects.append((fx, uy + uh, fw, fy + fh - (uy + uh)))
+    return rects
+
+def rect_contains(a, b):
+    return (b[0] >= a[0] and b[1] >= a[1]
+            and b[0] + b[2] <= a[0] + a[2] and b[1] + b[3] <= a[1] + a[3])
+
+g_pack_orders = (
+    # Sort keys tried by pack_parts(), largest parts first.
+    lambda size: -(size[0] * size[1]),
+    lambda size: -max(size),
+    lambda size: -size[1],
+    lambda size: -size[0],
+)
+
+def pack_parts(parts):
+    # Pack parts onto as few pages as possible, rotating them if that
+    # helps.  Each part goes where it fits best on any open page, and a
+    # new page is only started when it fits nowhere.  A few part orders
+    # are tried and the layout with the fewest pages wins.  Parts which
+    # fit in another part's cutout are nested there first.
+    contents = {}
+    if g_nest:
+        (parts, contents) = nest_in_holes(parts)
+    best = None
+    for order in g_pack_orders:
+        indices = sorted(range(len(parts)), key=lambda i: order(get_part_bounds(parts[i])))
+        pages = pack_parts_ordered([parts[i] for i in indices], [contents.get(i, []) for i in indices])
+        if best is None or len(pages) < len(best):
+            best = pages
+    return best
+
+def pack_parts_ordered(parts, contents=None):
+    # contents, if given, are the placements nested in each part, in the
+    # part's own coordinates.
+    (area_x, area_y, area_w, area_h) = layout_area()
+    bins = []
+    pages = []
+    for (k, part) in enumerate(parts):
+        (w, h) = get_part_bounds(part)
+        # Each part reserves the gap below and to the right of itself.
+        gap = part_gap()
+        (w, h) = (w + gap, h + gap)
+        best = None
+        for (i, page_bin) in enumerate(bins):
+            fit = page_bin.find(w, h)
+            if fit is not None and (best is None or fit[0] < best[1][0]):
+                best = (i, fit)
+        if best is None:
+            bins.append(MaxRectsBin(area_w + gap, area_h + gap))
+            pages.append([])
+            fit = bins[-1].find(w, h)
+            if fit is None:
+                raise ValueError("%s %s doesn't fit on a page" % part)
+            best = (len(bins) - 1, fit)
+        (i, (score, x, y, rotated)) = best
+        if rotated:
+            bins[i].insert(x, y, h, w)
+        else:
+            bins[i].insert(x, y, w, h)
+        placement = (part, area_x + x, area_y + y, rotated)
+        pages[i].append(placement)
+        if contents is not None:
+            pages[i].extend(place_in_part(placement, inner) for inner in contents[k])
+    return pages
+
+def nest_in_holes(parts):
+    # Fill the cutouts of the parts which have them (see g_part_holes)
+    # with other parts, largest first, each g_gap clear of the cutout's
+    # edges and of the others.  Each cutout is packed as a MaxRectsBin
+    # of its own.  Returns the parts which are left to lay out and, for
+    # those with parts nested in them, {index: [placements in the part's
+    # own coordinates]}.
+    holes = []
+    for (i, part) in enumerate(parts):
+        for (hx, hy, hw, hh) in get_part_holes(part):
+            holes.append((i, hx + g_gap, hy + g_gap, MaxRectsBin(hw - g_gap, hh - g_gap)))
+    if len(holes) == 0:
+        return (parts, {})
+    nested = {}
+    left = []
+    area = lambda i: get_part_bounds(parts[i])[0] * get_part_bounds(parts[i])[1]
+    for i in sorted(range(len(parts)), key=lambda i: -area(i)):
+        (w, h) = get_part_bounds(parts[i])
+        best = None
+        if len(get_part_holes(parts[i])) == 0:
+            for hole in holes:
+                fit = hole[3].find(w + g_gap, h + g_gap)
+                if fit is not None and (best is None or fit[0] < best[1][0]):
+                    best = (hole, fit)
+        if best is None:
+            left.append(i)
+            continue
+        ((host, hx, hy, hole_bin), (score, x, y, rotated)) = best
+        if rotated:
+            hole_bin.insert(x, y, h + g_gap, w + g_gap)
+        else:
+            hole_bin.insert(x, y, w + g_gap, h + g_gap)
+        nested.setdefault(host, []).append((parts[i], hx + x, hy + y, rotated))
+    left.sort()
+    return ([parts[i] for i in left], dict((k, nested[i]) for (k, i) in enumerate(left) if i in nested))
+
+def place_in_part(host, inner):
+    # inner is a placement in the host part's own coordinates, return it
+    # in page mm.  In a rotated host a rotated part would be turned all
+    # the way round, which is the same piece of foam, so it's unrotated.
+    (part, x, y, rotated) = host
+    (inner_part, u, v, inner_rotated) = inner
+    if not rotated:
+        return (inner_part, x + u, y + v, inner_rotated)
+    (_, _, iw, ih) = placement_rect(inner)
+    return (inner_part, x + v, y + get_part_bounds(part)[0] - u - iw, not inner_rotated)
+
+def placement_holes(placement):
+    # The part's cutouts, (x, y, w, h) in page mm.
+    (part, x, y, rotated) = placement
+    holes = get_part_holes(part)
+    if rotated:
+        w = get_part_bounds(part)[0]
+        return [(x + hy, y + w - hx - hw, hh, hw) for (hx, hy, hw, hh) in holes]
+    return [(x + hx, y + hy, hw, hh) for (hx, hy, hw, hh) in holes]
+
+def nested_placements(placements):
+    # The placements which lie in another part's cutout.
+    holes = [hole for placement in placements for hole in placement_holes(placement)]
+    return [p for p in placements if any(rect_contains(hole, placement_rect(p)) for hole in holes)]
+
+g_layouts = {
+    "stack": stack_parts,
+    "pack": pack_parts,
+}
+
+def page_utilisation(placements):
+    # The fraction of the page area covered by the parts' bounding boxes.
+    # Nested parts are inside their hosts' bounds and don't count again.
+    (area_x, area_y, area_w, area_h) = layout_area()
+    used = sum(w * h for (x, y, w, h) in map(placement_rect, placements))
+    used -= nested_area(placements)
+    return used / (area_w * area_h)
+
+def nested_area(placements):
+    # The area of foam reclaimed from cutouts, in mm2.
+    return sum(w * h for (x, y, w, h) in map(placement_rect, nested_placements(placements)))
+
+def fits_on_page(part):
+    # Whether the pack layout can place the part, either way round.
+    (area_x, area_y, area_w, area_h) = layout_area()
+    (w, h) = get_part_bounds(part)
+    return (w <= area_w and h <= area_h) or (h <= area_w and w <= area_h)
+
+def check_parts_fit(parts, layout=None):
+    # Raises ValueError, before any layout, if the pack layout can't
+    # place one of the parts.
+    if (layout or g_layout) != "pack":
+        return
+    for part in dict.fromkeys(parts):
+        if not fits_on_page(part):
+            raise ValueError("%s's %s (%.1f x %.1f mm) doesn't fit on a page, try --layout stack"
+                             % ((part[1], part[0]) + get_part_bounds(part)))
+
+def placement_rect(placement):
+    (part, x, y, rotated) = placement
+    (w, h) = get_part_bounds(part)
+    if rotated:
+        (w, h) = (h, w)
+    return (x, y, w, h)
+
+
+# Output backends:
+#
+# A page backend receives paths ((N, 2) arrays) and text in mm (page
+# coordinates, y down) and knows how to render itself to
+# "<basename>.pdf".  Paths are collected and converted to the output's
+# units with one array operation per page.  Backends which finish with a
+# subprocess (rsvg-convert) return a Conversion from write(), so it can
+# run in the background while the next page is drawn.
+
+g_font_size = 12  # points
+g_keep_svg = True  # False pipes the SVG to rsvg-convert without saving it.
+g_svgz = False  # Save SVGs gzipped, as .svgz.
+g_svg_precision = 2  # Decimal places of a px in CompactSvgPage's coordinates.
+
+class Page:
+    outputs = ()  # The files render() writes, by extension.
+    ruler = True  # Whether draw_page() draws the ruler.
+
+    def write(self, basename):
+        # Write what can be written in this process and return the
+        # Conversion which finishes rendering, or None if nothing is left.
+        self.render(basename)
+        return None
+
+    def start(self, out_dir):
+        # Called by start_drawing(), before anything is drawn, with the
+        # directory the page will be rendered to.
+        pass
+
+    def discard(self):
+        # Called instead of render() when the page isn't needed after all,
+        # or couldn't be drawn.
+        pass
+
+    def cached(self, basename):
+        # Called instead of write() when the page's outputs came from the
+        # cache.
+        self.discard()
+
+class SvgPage(Page):
+    # Draws with drawSvg, then converts the SVG to PDF with rsvg-convert.
+    outputs = ("svg", "pdf")
+
+    def __init__(self):
+        self.paths = []
+        self.elements = []  # drawSvg.Text objects, or (index into paths, closed).
+
+    def path(self, points, closed):
+        self.elements.append((len(self.paths), closed))
+        self.paths.append(points)
+
+    def text(self, content, x, y, align_right=False):
+        if align_right:
+            self.elements.append(
+                drawSvg.Text(
+                    content,
+                    g_font_size * g_dpi / 72 * g_fudge,
+                    mm_to_px(x),
+                    mm_to_px(flip_y(y)),
+                    text_anchor="end"
+                )
+            )
+        else:
+            self.elements.append(
+                drawSvg.Text(
+                    content,
+                    g_font_size * g_dpi / 72 * g_fudge,
+                    mm_to_px(x),
+                    mm_to_px(flip_y(y))
+                )
+            )
+
+    def get_drawing(self):
+        drawing = drawSvg.Drawing(
+            mm_to_px(g_size_mm[0]),
+            mm_to_px(g_size_mm[1])
+        )
+        paths = transform_paths(self.paths, page_to_px)
+        for element in self.elements:
+            if isinstance(element, tuple):
+                (i, closed) = element
+                drawing.append(svg_path(paths[i].tolist(), closed))
+            else:
+                drawing.append(element)
+        return drawing
+
+    def svg(self):
+        return self.get_drawing().asSvg()
+
+    def write(self, basename):
+        if not g_keep_svg:
+            return Conversion(rsvg_command(), self.svg().encode("utf-8"), "%s.pdf" % basename)
+        path = "%s.%s" % (basename, svg_ext())
+        write_svg(path, self.svg())
+        return Conversion(rsvg_command([path], "%s.pdf" % basename))
+
+    def render(self, basename):
+        run_conversion(self.write(basename))
+
+    def save_temp(self, out_dir):
+        (fd, path) = tempfile.mkstemp(suffix=".svg.tmp", dir=out_dir or ".")
+        os.close(fd)
+        write_svg(path, self.svg())
+        return path
+
+    @staticmethod
+    def combine(pages, basename):
+        combine_svgs([page.save_temp(os.path.dirname(basename)) for page in pages], basename)
+
+def combine_svgs(paths, basename):
+    # rsvg-convert writes one PDF page per SVG it is given.
+    try:
+        run_conversion(Conversion(rsvg_command(paths, "%s.pdf" % basename)))
+    finally:
+        for path in paths:
+            os.remove(path)
+
+def page_outputs(backend):
+    # The files each page of a backend is rendered to, by extension.
+    if not g_keep_svg:
+        return tuple(ext for ext in backend.outputs if ext != "svg")
+    return tuple(svg_ext() if ext == "svg" else ext for ext in backend.outputs)
+
+def svg_ext():
+    return "svgz" if g_svgz else "svg"
+
+def write_svg(path, svg):
+    if path.endswith(".svgz"):
+        # No timestamp in the header, so the same SVG gives the same bytes.
+        with gzip.GzipFile(path, "wb", mtime=0) as f:
+            f.write(svg.encode("utf-8"))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(svg)
+
+def rsvg_command(svg_paths=(), pdf_path=None):
+    # Without paths, rsvg-convert reads the SVG from stdin and writes the
+    # PDF to stdout.
+    command = ["rsvg-convert", "-f", "pdf", "--dpi-x", "600", "--dpi-y", "600"]
+    if pdf_path is not None:
+        command += ["-o", pdf_path]
+    return command + list(svg_paths)
+
+class Conversion(NamedTuple):
+    # A command which finishes rendering a page.
+    command: list
+    data: bytes = None  # Fed to the command's stdin.
+    stdout_path: str = None  # Where the command's stdout is written.
+    remove_path: str = None  # Removed once the command has run.
+
+def run_conversion(conversion):
+    (command, data, stdout_path, remove_path) = conversion
+    if stdout_path is None:
+        subprocess.run(command, input=data, check=True)
+    else:
+        with open(stdout_path, "wb") as f:
+            subprocess.run(command, input=data, stdout=f, check=True)
+    if remove_path is not None:
+        os.remove(remove_path)
+
+def svg_path(points, closed):
+    p = drawSvg.Path(stroke='black', stroke_width=2, fill='none')
+    p.M(*points[0])
+    for (x, y) in points[1:]:
+        p.L(x, y)
+    if closed:
+        p.Z()
+    return p
+
+class StreamingSvgPage(Page):
+    # Writes each path and text element to the SVG file as soon as it is
+    # drawn, so memory use doesn't grow with the page.  The output is
+    # the same as SvgPage's.  The file is written under a temporary name
+    # in the output directory until render() knows what to call it.
+    outputs = ("svg", "pdf")
+
+    def __init__(self):
+        self.f = None
+        self.tmp_path = None
+
+    def start(self, out_dir):
+        (fd, self.tmp_path) = tempfile.mkstemp(suffix=".svg.tmp", dir=out_dir or ".")
+        self.f = os.fdopen(fd, "w", encoding="utf-8")
+        (w, h) = (mm_to_px(g_size_mm[0]), mm_to_px(g_size_mm[1]))
+        self.f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"\n'
+            '     width="%s" height="%s" viewBox="0 %s %s %s">\n'
+            '<defs>\n'
+            '</defs>\n' % (w, h, -h, w, h)
+        )
+
+    def path(self, points, closed):
+        # Like drawSvg, SVG y is the negated (y up) px.
+        points = page_to_px(points).tolist()
+        d = ["M%s,%s" % (points[0][0], -points[0][1])]
+        for (x, y) in points[1:]:
+            d.append("L%s,%s" % (x, -y))
+        if closed:
+            d.append("Z")
+        self.f.write('<path d="%s" stroke="black" stroke-width="2" fill="none" />\n' % " ".join(d))
+
+    def text(self, content, x, y, align_right=False):
+        anchor = ' text-anchor="end"' if align_right else ""
+        self.f.write('<text x="%s" y="%s" font-size="%s"%s dy="0em">%s</text>\n' % (
+            mm_to_px(x), -mm_to_px(flip_y(y)), g_font_size * g_dpi / 72 * g_fudge,
+            anchor, saxutils.escape(content)
+        ))
+
+    def finish(self):
+        self.f.write("</svg>")
+        self.f.close()
+        self.f = None
+        return self.tmp_path
+
+    def write(self, basename):
+        if not g_keep_svg:
+            path = self.finish()
+            return Conversion(rsvg_command([path], "%s.pdf" % basename), remove_path=path)
+        path = "%s.%s" % (basename, svg_ext())
+        if g_svgz:
+            try:
+                with open(self.finish(), encoding="utf-8") as f:
+                    write_svg(path, f.read())
+            finally:
+                os.remove(self.tmp_path)
+        else:
+            os.replace(self.finish(), path)
+        return Conversion(rsvg_command([path], "%s.pdf" % basename))
+
+    def render(self, basename):
+        run_conversion(self.write(basename))
+
+    @staticmethod
+    def combine(pages, basename):
+        combine_svgs([page.finish() for page in pages], basename)
+
+    def discard(self):
+        # Nothing to do if it was never started or has been finished.
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            os.remove(self.tmp_path)
+
+class CompactSvgPage(SvgPage):
+    # Writes its own SVG, several times smaller than drawSvg's: points
+    # are rounded to g_svg_precision decimal places of a px, y is down
+    # so nothing is negated, and the paths are subpaths of a single
+    # <path> in relative l, h and v commands.  Shapes drawn more than
+    # once on the page (see shape_key()) are defined once in <defs> and
+    # placed with <use>.  The stroke attributes are set once, on a group
+    # around it all.
+
+    def __init__(self):
+        self.paths = []
+        self.closed = []
+        self.texts = []
+
+    def path(self, points, closed):
+        self.paths.append(points)
+        self.closed.append(closed)
+
+    def text(self, content, x, y, align_right=False):
+        anchor = ' text-anchor="end"' if align_right else ""
+        self.texts.append('<text x="%s" y="%s" font-size="%s"%s>%s</text>' % (
+            svg_number(svg_units(mm_to_px(x))), svg_number(svg_units(mm_to_px(y))),
+            svg_number(svg_units(g_font_size * g_dpi / 72 * g_fudge)), anchor, saxutils.escape(content)
+        ))
+
+    def svg(self):
+        (w, h) = (svg_number(svg_units(mm_to_px(g_size_mm[0]))), svg_number(svg_units(mm_to_px(g_size_mm[1]))))
+        units = []
+        if len(self.paths) > 0:
+            units = np.split(svg_units(mm_to_px(np.concatenate(self.paths))),
+                             np.cumsum([len(points) for points in self.paths])[:-1])
+        keys = [shape_key(points, closed) for (points, closed) in zip(units, self.closed)]
+        counts = collections.Counter(keys)
+        symbols = {}  # shape key -> id, or None if it isn't worth one.
+        (defs, uses, unique) = ([], [], [])
+        for (points, closed, key) in zip(units, self.closed, keys):
+            if key is not None and key not in symbols:
+                d = compact_path_data([points - points[0]], [closed])
+                symbols[key] = None
+                if worth_reusing(counts[key], len(d), len('<use xlink:href="#s%d" x="0000.00" y="0000.00"/>' % len(defs))):
+                    symbols[key] = "s%d" % len(defs)
+                    defs.append('<path id="%s" d="%s"/>' % (symbols[key], d))
+            if symbols.get(key) is None:
+                unique.append((points, closed))
+            else:
+                uses.append('<use xlink:href="#%s" x="%s" y="%s"/>' % (symbols[key], svg_number(points[0][0]), svg_number(points[0][1])))
+        out = [
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<svg xmlns="http://www.w3.org/2000/svg"%s width="%s" height="%s" viewBox="0 0 %s %s">'
+            % (' xmlns:xlink="http://www.w3.org/1999/xlink"' if len(defs) > 0 else "", w, h, w, h)
+        ]
+        if len(defs) > 0:
+            out += ["<defs>"] + defs + ["</defs>"]
+        out.append('<g stroke="black" stroke-width="2" fill="none">')
+        if len(unique) > 0:
+            out.append('<path d="%s"/>' % compact_path_data(*zip(*unique)))
+        out += uses
+        out.append("</g>")
+        out += self.texts
+        out.append("</svg>\n")
+        return "\n".join(out)
+
+def shape_key(units, closed):
+    # Paths with the same key are the same shape at different offsets.
+    # units is an (N, 2) integer array.  Lines (two points) aren't worth
+    # reusing and get None.
+    if len(units) <= 2:
+        return None
+    return (closed, len(units), (units - units[0]).tobytes())
+
+def worth_reusing(count, shape_bytes, use_bytes):
+    # Whether drawing a shape count times by reference is smaller than
+    # drawing it out each time.  Small rectangles usually aren't.
+    return count * shape_bytes > shape_bytes + count * use_bytes
+
+def svg_units(px):
+    # px -> whole multiples of 10^-g_svg_precision px.
+    return np.rint(np.asarray(px) * 10 ** g_svg_precision).astype(np.int64)
+
+def svg_number(units):
+    # Whole units -> the shortest number SVG accepts for them: 12, 1.5, .25, -.5.
+    (whole, fraction) = divmod(abs(int(units)), 10 ** g_svg_precision)
+    text = str(whole)
+    if fraction != 0:
+        text = ("%d.%0*d" % (whole, g_svg_precision, fraction)).rstrip("0")
+        if whole == 0:
+            text = text[1:]
+    return "-" + text if units < 0 else text
+
+def svg_pair(a, b):
+    # A minus sign separates numbers as well as a space does.
+    (a, b) = (svg_number(a), svg_number(b))
+    return a + b if b.startswith("-") else a + " " + b
+
+def compact_path_data(paths, closed):
+    # paths are (N, 2) arrays of svg_units().  The first subpath starts
+    # with an absolute M, the others move relative to where the last one
+    # left the pen: its start if it was closed, else its end.
+    d = []
+    at = None
+    for (points, c) in zip(paths, closed):
+        if at is None:
+            d.append("M" + svg_pair(*points[0]))
+        else:
+            d.append("m" + svg_pair(points[0][0] - at[0], points[0][1] - at[1]))
+        for (dx, dy) in np.diff(points, axis=0).tolist():
+            if dy == 0:
+                d.append("h" + svg_number(dx))
+            elif dx == 0:
+                d.append("v" + svg_number(dy))
+            else:
+                d.append("l" + svg_pair(dx, dy))
+        if c:
+            d.append("z")
+        at = points[0] if c else points[-1]
+    return "".join(d)
+
+# Helvetica advance widths (1/1000 em) for WinAnsi characters 32-126,
+# needed to right-align text in the PDF backend.
+g_helvetica_widths = (
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+)
+
+def helvetica_width_pt(content, size_pt):
+    widths = [g_helvetica_widths[ord(c) - 32] if 32 <= ord(c) <= 126 else 556 for c in content]
+    return sum(widths) * size_pt / 1000
+
+def pdf_string(content):
+    escaped = content.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return "(%s)" % escaped
+
+class PdfPage(Page):
+    # Writes a PDF directly from the paths and text, with no subprocess.
+    # Paths are vector strokes, text uses the built-in Helvetica font.
+    outputs = ("pdf",)
+
+    def __init__(self):
+        self.paths = []
+        self.elements = []  # Text operators, or (index into paths, closed).
+        self.units = None  # The paths in 1/1000 pt, see get_units().
+
+    def path(self, points, closed):
+        self.elements.append((len(self.paths), closed))
+        self.paths.append(points)
+
+    def text(self, content, x, y, align_right=False):
+        size = g_font_size * g_fudge
+        x_pt = mm_to_pt(x)
+        if align_right:
+            x_pt -= helvetica_width_pt(content, size)
+        self.elements.append(
+            "BT /F1 %.3f Tf %.3f %.3f Td %s Tj ET" % (
+                size, x_pt, mm_to_pt(flip_y(y)), pdf_string(content)
+            )
+        )
 
-def start_drawing(case, page):
-    global g_drawing
-    g_drawing = drawSvg.Drawing(
-        mm_to_px(g_size_mm[0]),
-        mm_to_px(g_size_mm[1])
+    def get_units(self):
+        if self.units is None:
+            self.units = [np.rint(points * 1000).astype(np.int64) for points in transform_paths(self.paths, page_to_pt)]
+        return self.units
+
+    def shape_keys(self):
+        units = self.get_units()
+        return [shape_key(units[element[0]], element[1]) for element in self.elements if isinstance(element, tuple)]
+
+    def get_ops(self, shapes={}):
+        # shapes maps shape_key()s to the names of the Form XObjects
+        # which draw them, see combine().
+        ops = ["%.3f w" % (2 * 72 / g_dpi)]  # 2px at g_dpi, like the SVG.
+        units = self.get_units()
+        for element in self.elements:
+            if isinstance(element, tuple):
+                (i, closed) = element
+                name = shapes.get(shape_key(units[i], closed))
+                if name is None:
+                    ops.append(pdf_path((units[i] / 1000).tolist(), closed))
+                else:
+                    ops.append("q 1 0 0 1 %.3f %.3f cm /%s Do Q" % (units[i][0][0] / 1000, units[i][0][1] / 1000, name))
+            else:
+                ops.append(element)
+        return ops
+
+    def render(self, basename):
+        PdfPage.combine([self], basename)
+
+    @staticmethod
+    def combine(pages, basename):
+        # Shapes drawn more than once anywhere in the document are
+        # defined once, as Form XObjects, and drawn at each offset.
+        # Objects 1-4 are the catalog, the page tree, the font and the
+        # resources all the pages share, then the XObjects, then each
+        # page and its content stream.
+        counts = collections.Counter(key for page in pages for key in page.shape_keys())
+        xobjects = []
+        for (key, count) in counts.items():
+            if key is None or count < 2:
+                continue
+            (closed, n, offsets) = key
+            points = np.frombuffer(offsets, dtype=np.int64).reshape(n, 2) / 1000
+            (low, high) = (points.min(axis=0) - 1, points.max(axis=0) + 1)  # 1pt for the stroke.
+            content = pdf_path(points.tolist(), closed).encode("ascii")
+            xobject = (
+                b"<< /Type /XObject /Subtype /Form /BBox [%.3f %.3f %.3f %.3f] /Length %d >>\nstream\n"
+                % (low[0], low[1], high[0], high[1], len(content)) + content + b"\nendstream"
+            )
+            if worth_reusing(count, len(content), len(b"q 1 0 0 1 000.000 000.000 cm /S0 Do Q") + len(xobject) // count):
+                xobjects.append((key, xobject))
+        shapes = dict((key, "S%d" % i) for (i, (key, _)) in enumerate(xobjects))
+        first_page = 5 + len(xobjects)
+        kids = " ".join("%d 0 R" % (first_page + i * 2) for i in range(len(pages)))
+        names = "".join(" /S%d %d 0 R" % (i, 5 + i) for i in range(len(xobjects)))
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            ("<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(pages))).encode("ascii"),
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+            ("<< /Font << /F1 3 0 R >>%s >>" % (" /XObject <<%s >>" % names if names else "")).encode("ascii"),
+        ]
+        objects += [xobject for (_, xobject) in xobjects]
+        for (i, page) in enumerate(pages):
+            content = "\n".join(page.get_ops(shapes)).encode("latin-1", "replace")
+            objects.append((
+                "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.3f %.3f]"
+                " /Resources 4 0 R /Contents %d 0 R >>"
+                % (mm_to_pt(g_size_mm[0]), mm_to_pt(g_size_mm[1]), first_page + i * 2 + 1)
+            ).encode("ascii"))
+            objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        with open("%s.pdf" % basename, "wb") as f:
+            f.write(pdf_document(objects))
+
+def pdf_path(points, closed):
+    ops = ["%.3f %.3f m" % tuple(points[0])]
+    for (x, y) in points[1:]:
+        ops.append("%.3f %.3f l" % (x, y))
+    if closed:
+        ops.append("h")
+    ops.append("S")
+    return " ".join(ops)
+
+def pdf_document(objects):
+    # Serialise a list of PDF object bodies (numbered from 1) with an xref table.
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for (i, body) in enumerate(objects):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % (i + 1) + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+# Cutter backends:
+#
+# Drag-knife cutters and lasers follow the outlines directly, so these
+# write the paths as tool paths in mm (y up from the bottom left of the
+# page), ordered to keep pen-up travel between outlines short (see
+# "Tool-path optimisation" below).  There is no ruler, since it would be
+# cut out too.
+
+g_job_times = False  # Print each page's estimated cutting time.
+
+class CutterPage(Page):
+    ruler = False
+
+    def __init__(self):
+        self.paths = []
+        self.closed = []
+        self.labels = []  # (content, x, y, align_right) in cutter mm.
+
+    def path(self, points, closed):
+        self.paths.append(points)
+        self.closed.append(closed)
+
+    def text(self, content, x, y, align_right=False):
+        self.labels.append((content, x, flip_y(y), align_right))
+
+    def tool_paths(self):
+        # [(points, closed)] in cutter mm, in the order to cut them.
+        (paths, closed) = (transform_paths(self.paths, page_to_mm), self.closed)
+        if g_common_line:
+            (paths, closed) = merge_common_lines(paths, closed)
+        return optimise_tool_paths(paths, closed)
+
+    def render(self, basename):
+        path = "%s.%s" % (basename, self.outputs[0])
+        tool_paths = self.tool_paths()
+        with open(path, "w", encoding="ascii", errors="replace") as f:
+            f.write(self.serialise(tool_paths))
+        self.report(path, tool_paths)
+
+    def cached(self, basename):
+        # The estimates are still wanted when the file came from the cache.
+        if g_job_times or g_common_line:
+            self.report("%s.%s" % (basename, self.outputs[0]), self.tool_paths())
+
+    def report(self, path, tool_paths):
+        # To stderr, since stdout is the --serve protocol.
+        if not (g_job_times or g_common_line):
+            return
+        drawn = [(points.tolist(), c) for (points, c) in zip(transform_paths(self.paths, page_to_mm), self.closed)]
+        (before, cut_before, travel_before) = job_stats(drawn)
+        (after, cut, travel_after) = job_stats(tool_paths)
+        if g_common_line:
+            sys.stderr.write("%s: common lines save %.0fmm of %.0fmm cutting (%.0f%%)\n"
+                             % (path, cut_before - cut, cut_before, (cut_before - cut) * 100 / max(cut_before, 1e-9)))
+        if g_job_times:
+            sys.stderr.write("%s: about %.0fs to cut, was %.0fs as drawn (%.0fmm cutting, %.0fmm travel, was %.0fmm)\n"
+                             % (path, after, before, cut, travel_after, travel_before))
+
+# Tool-path optimisation:
+#
+# Paths are drawn part by part, each starting wherever its outline
+# happens to start.  For cutting, the order of the paths, the vertex
+# each closed path starts at and the end each open path starts from are
+# chosen to cut down pen-up travel: greedily (nearest neighbour), then
+# improved by 2-opt, reversing runs of the sequence while that shortens
+# it.  Closed paths keep the direction they were drawn in, so a drag
+# knife's trailing offset stays on the same side of every outline.
+#
+# A part comes loose once its outline is cut and anything cut after
+# that may shift, so a path inside a closed path (a cutout, a part
+# nested in a cutout) is always cut before it: neither step ever makes
+# a move which would put an outline before something inside it.
+
+g_cut_speed = 20  # mm/s, roughly what a hobby drag-knife cutter does in foam.
+g_travel_speed = 100  # mm/s with the pen up.
+g_lift_seconds = 0.2  # To lift the pen and put it down again.
+g_two_opt_passes = 20
+
+def optimise_tool_paths(paths, closed, home=(0, 0)):
+    # paths are (N, 2) arrays.  Returns [(points, closed)] in cutting order.
+    n = len(paths)
+    if n == 0:
+        return []
+    # Every place a path can be entered: any vertex of a closed path,
+    # either end of an open one.
+    owners = []
+    vertices = []
+    for (i, (points, c)) in enumerate(zip(paths, closed)):
+        for v in (range(len(points)) if c else (0, len(points) - 1)):
+            owners.append(i)
+            vertices.append(v)
+    owners = np.array(owners)
+    candidates = np.array([paths[i][v] for (i, v) in zip(owners, vertices)])
+    inside = path_containment(paths, closed)
+    related = inside | inside.T
+
+    # Nearest neighbour, only to paths with nothing left to cut inside them.
+    sequence = []
+    entry_vertex = {}
+    done = np.zeros(len(candidates), dtype=bool)
+    cut = np.zeros(n, dtype=bool)
+    at = np.array(home, dtype=float)
+    for _ in range(n):
+        distances = np.hypot(candidates[:, 0] - at[0], candidates[:, 1] - at[1])
+        distances[done] = np.inf
+        distances[(inside[~cut].any(axis=0))[owners]] = np.inf
+        k = int(np.argmin(distances))
+        (i, v) = (owners[k], vertices[k])
+        sequence.append(i)
+        entry_vertex[i] = v
+        done[owners == i] = True
+        cut[i] = True
+        at = paths[i][v] if closed[i] else paths[i][len(paths[i]) - 1 - v]
+
+    # 2-opt.  Reversing sequence[i:j+1] also reverses each path in it,
+    # so each path's entry and exit swap.  It would also reverse the
+    # order of any path and one inside it, so such runs are left alone.
+    entries = np.array([paths[i][entry_vertex[i]] for i in sequence])
+    exits = np.array([paths[i][entry_vertex[i]] if closed[i] else paths[i][len(paths[i]) - 1 - entry_vertex[i]]
+                      for i in sequence])
+    flipped = np.zeros(n, dtype=bool)
+    sequence = np.array(sequence)
+    for _ in range(g_two_opt_passes):
+        improved = False
+        for i in range(n):
+            before = np.array(home, dtype=float) if i == 0 else exits[i - 1]
+            j = np.arange(i, n)
+            following = np.append(entries[i + 1:], [[np.nan, np.nan]], axis=0)
+            old = np.hypot(*(entries[i] - before)) + np.nan_to_num(np.hypot(*(exits[j] - following).T))
+            new = np.hypot(*(exits[j] - before).T) + np.nan_to_num(np.hypot(*(entries[i] - following).T))
+            run = related[np.ix_(sequence[i:], sequence[i:])]
+            new[np.logical_or.accumulate(np.tril(run, -1).any(axis=1))] = np.inf
+            best = int(np.argmin(new - old))
+            if new[best] - old[best] < -1e-6:
+                j = i + best
+                (entries[i:j + 1], exits[i:j + 1]) = (exits[i:j + 1][::-1].copy(), entries[i:j + 1][::-1].copy())
+                sequence[i:j + 1] = sequence[i:j + 1][::-1].copy()
+                flipped[i:j + 1] = ~flipped[i:j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+
+    tool_paths = []
+    for (i, flip) in zip(sequence, flipped):
+        points = paths[i]
+        if closed[i]:
+            points = np.roll(points, -entry_vertex[i], axis=0)
+        elif (entry_vertex[i] != 0) != flip:
+            points = points[::-1]
+        tool_paths.append((points.tolist(), closed[i]))
+    return tool_paths
+
+def path_containment(paths, closed):
+    # inside[a, b]: whether path a lies inside the closed path b.
+    n = len(paths)
+    inside = np.zeros((n, n), dtype=bool)
+    lows = [points.min(axis=0) for points in paths]
+    highs = [points.max(axis=0) for points in paths]
+    for b in range(n):
+        if not closed[b]:
+            continue
+        polygon = paths[b].tolist()
+        edges = list(zip(polygon, polygon[1:] + polygon[:1]))
+        for a in range(n):
+            if a == b or not (np.all(lows[a] >= lows[b]) and np.all(highs[a] <= highs[b])):
+                continue
+            if np.prod(highs[a] - lows[a]) >= np.prod(highs[b] - lows[b]):
+                continue
+            inside[a, b] = all(point_in_polygon(point, edges) for point in paths[a].tolist())
+    return inside
+
+# Common lines:
+#
+# With g_common_line the pack layout abuts parts, so where an edge lies
+# along an edge of a part already cut (a side's short edge on the long
+# edge of the side below it, two bottoms side by side) the overlap needs
+# no second cut.  Edges are grouped by the line they lie on, and each
+# edge only keeps the stretches of it which no earlier edge on that
+# line covered.  A path which loses any of its edges is split into open
+# paths, which the tool-path optimiser can enter from either end.
+
+def merge_common_lines(paths, closed):
+    # paths are (N, 2) arrays.  Returns (paths, closed) with every
+    # stretch of line cut once.
+    done = collections.defaultdict(list)  # line -> [(t0, t1)] already cut.
+    (merged, merged_closed) = ([], [])
+    for (points, c) in zip(paths, closed):
+        points = points.tolist()
+        loop = points + points[:1] if c else points
+        runs = []
+        whole = True
+        for (a, b) in zip(loop, loop[1:]):
+            pieces = uncut_pieces(a, b, done)
+            whole = whole and pieces == [(a, b)]
+            for (p, q) in pieces:
+                if len(runs) > 0 and math.hypot(runs[-1][-1][0] - p[0], runs[-1][-1][1] - p[1]) < 1e-6:
+                    runs[-1].append(q)
+                else:
+                    runs.append([p, q])
+        if whole:
+            merged.append(np.array(points))
+            merged_closed.append(c)
+            continue
+        if c and len(runs) > 1 and math.hypot(runs[-1][-1][0] - runs[0][0][0], runs[-1][-1][1] - runs[0][0][1]) < 1e-6:
+            # The first and last runs meet where the outline started.
+            runs[0] = runs.pop()[:-1] + runs[0]
+        merged += [np.array(run) for run in runs]
+        merged_closed += [False] * len(runs)
+    return (merged, merged_closed)
+
+def line_key(a, b):
+    # (the line through a and b, where a and b are along it), or None if
+    # they're the same point.  The line is its direction, pointing right
+    # (or down), and its distance from the origin.
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    length = math.hypot(dx, dy)
+    if length < 1e-9:
+        return None
+    (ux, uy) = (dx / length, dy / length)
+    if ux < -1e-9 or (abs(ux) <= 1e-9 and uy < 0):
+        (ux, uy) = (-ux, -uy)
+    line = (round(ux, 6), round(uy, 6), round(a[0] * uy - a[1] * ux, 3))
+    return (line, a[0] * ux + a[1] * uy, b[0] * ux + b[1] * uy)
+
+def uncut_pieces(a, b, done):
+    # The [(p, q)] stretches of the edge a-b which aren't in done, in
+    # a-b's direction, and mark the whole edge done.
+    key = line_key(a, b)
+    if key is None:
+        return []
+    (line, ta, tb) = key
+    (t0, t1) = (min(ta, tb), max(ta, tb))
+    pieces = [(t0, t1)]
+    for (c0, c1) in done[line]:
+        split = []
+        for (p0, p1) in pieces:
+            if c1 <= p0 + 1e-6 or c0 >= p1 - 1e-6:
+                split.append((p0, p1))
+                continue
+            if c0 - p0 > 1e-3:
+                split.append((p0, c0))
+            if p1 - c1 > 1e-3:
+                split.append((c1, p1))
+        pieces = split
+    done[line].append((t0, t1))
+    if pieces == [(t0, t1)]:
+        return [(a, b)]
+    at = lambda t: a if t == ta else b if t == tb else [a[0] + (b[0] - a[0]) * (t - ta) / (tb - ta), a[1] + (b[1] - a[1]) * (t - ta) / (tb - ta)]
+    if ta > tb:
+        pieces = [(p1, p0) for (p0, p1) in reversed(pieces)]
+    return [(at(p0), at(p1)) for (p0, p1) in pieces]
+
+def job_stats(tool_paths, home=(0, 0)):
+    # (seconds, cut mm, travel mm) for cutting [(points, closed)] in order.
+    cut = 0
+    travel = 0
+    lifts = 0
+    at = home
+    for (points, closed) in tool_paths:
+        step = math.hypot(points[0][0] - at[0], points[0][1] - at[1])
+        if step > 1e-6:
+            travel += step
+            lifts += 1
+        loop = points + points[:1] if closed else points
+        cut += sum(math.hypot(b[0] - a[0], b[1] - a[1]) for (a, b) in zip(loop, loop[1:]))
+        at = loop[-1]
+    seconds = cut / g_cut_speed + travel / g_travel_speed + lifts * g_lift_seconds
+    return (seconds, cut, travel)
+
+class DxfPage(CutterPage):
+    # Writes a DXF with an LWPOLYLINE per path on the CUT layer and the
+    # title as TEXT on the LABELS layer, which a laser can engrave or skip.
+    outputs = ("dxf",)
+
+    def serialise(self, tool_paths):
+        out = ["0", "SECTION", "2", "HEADER",
+               "9", "$ACADVER", "1", "AC1015",
+               "9", "$INSUNITS", "70", "4",  # mm
+               "0", "ENDSEC",
+               "0", "SECTION", "2", "ENTITIES"]
+        for (points, closed) in tool_paths:
+            out += ["0", "LWPOLYLINE", "100", "AcDbEntity", "8", "CUT", "100", "AcDbPolyline",
+                    "90", str(len(points)), "70", "1" if closed else "0"]
+            for (x, y) in points:
+                out += ["10", "%.3f" % x, "20", "%.3f" % y]
+        height = g_font_size * g_fudge * 25.4 / 72
+        for (content, x, y, align_right) in self.labels:
+            out += ["0", "TEXT", "100", "AcDbEntity", "8", "LABELS", "100", "AcDbText",
+                    "10", "%.3f" % x, "20", "%.3f" % y, "40", "%.3f" % height, "1", content]
+            if align_right:
+                out += ["72", "2", "11", "%.3f" % x, "21", "%.3f" % y]
+            out += ["100", "AcDbText"]
+        out += ["0", "ENDSEC", "0", "EOF"]
+        return "\n".join(out) + "\n"
+
+class HpglPage(CutterPage):
+    # Writes HPGL in plotter units (40 per mm) with pen 1.  Cutters can't
+    # write, so the title is left out.
+    outputs = ("plt",)
+
+    def serialise(self, tool_paths):
+        out = ["IN;SP1;"]
+        at = None
+        for (points, closed) in tool_paths:
+            if closed:
+                points = points + points[:1]
+            units = ["%d,%d" % (round(x * 40), round(y * 40)) for (x, y) in points]
+            if units[0] == at:
+                # Already there, keep the pen down.
+                out.append("PD%s;" % ",".join(units[1:]))
+            else:
+                out.append("PU%s;PD%s;" % (units[0], ",".join(units[1:])))
+            at = units[-1]
+        out.append("PU;SP0;")
+        return "\n".join(out) + "\n"
+
+class RecordingPage(Page):
+    # Records the line segments drawn on each page into `pages` (a dict
+    # of basename -> segments) instead of rendering, see check_geometry().
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.segments = []
+
+    def path(self, points, closed):
+        ends = np.roll(points, -1, axis=0) if closed else points[1:]
+        starts = points if closed else points[:-1]
+        for (a, b) in zip(np.round(starts, 6).tolist(), np.round(ends, 6).tolist()):
+            self.segments.append(tuple(min(a, b) + max(a, b)))
+
+    def text(self, content, x, y, align_right=False):
+        pass
+
+    def render(self, basename):
+        self.pages[basename] = sorted(self.segments)
+
+g_backends = {
+    "rsvg": SvgPage,
+    "stream": StreamingSvgPage,
+    "compact": CompactSvgPage,
+    "pdf": PdfPage,
+    "dxf": DxfPage,
+    "hpgl": HpglPage,
+}
+
+
+# Output cache:
+#
+# Rendered pages are stored in g_cache_dir under a hash of everything
+# which affects them (this script, the case, the globals and the backend),
+# so re-running with unchanged inputs copies the files instead of
+# re-rendering them.
+
+g_cache_dir = ".template-cache"  # None disables the cache.
+g_cache_max_pages = 1000  # Least recently used pages are evicted beyond this.
+g_force = False  # Re-render even if the page is cached.
+g_script_hash = None
+
+def script_hash():
+    global g_script_hash
+    if g_script_hash is None:
+        with open(os.path.abspath(__file__), "rb") as f:
+            g_script_hash = hashlib.sha256(f.read()).hexdigest()
+    return g_script_hash
+
+def cache_key(canvas, name, page, placements):
+    cases = sorted(set(case for ((kind, case), x, y, rotated) in placements))
+    inputs = (
+        script_hash(), name, page, placements, [g_cases[case] for case in cases],
+        g_foam_thick, g_dpi, g_fudge, g_size_mm, g_font_size, g_svgz, g_svg_precision,
+        canvas.backend.__name__, canvas.coalesce, g_common_line,
     )
-    warp(5, 10)
-    desc = g_cases[case][0]
-    text("EVA 6mm foam templates for %s, pg %s" % (desc, page))
+    return hashlib.sha256(repr(inputs).encode("utf-8")).hexdigest()
+
+def cache_path(key, ext):
+    return os.path.join(g_cache_dir, "%s.%s" % (key, ext))
+
+def cache_fetch(exts, key, basename):
+    # Copy a cached page to "<basename>.<ext>", returns False on a miss.
+    if not all(os.path.exists(cache_path(key, ext)) for ext in exts):
+        return False
+    for ext in exts:
+        shutil.copyfile(cache_path(key, ext), "%s.%s" % (basename, ext))
+        os.utime(cache_path(key, ext))  # Mark as recently used.
+    return True
+
+def cache_store(exts, key, basename):
+    # The cache is only an optimisation: a page which can't be stored is
+    # still a page drawn.
+    try:
+        os.makedirs(g_cache_dir, exist_ok=True)
+        for ext in exts:
+            # Copy then rename, so a concurrent reader never sees a partial
+            # file, through a name of our own as other threads may be storing
+            # the same page.
+            (fd, tmp) = tempfile.mkstemp(prefix=key + ".", suffix=".%s.tmp" % ext, dir=g_cache_dir)
+            os.close(fd)
+            try:
+                shutil.copyfile("%s.%s" % (basename, ext), tmp)
+                os.replace(tmp, cache_path(key, ext))
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+    except OSError as e:
+        sys.stderr.write("Not caching %s: %s\n" % (basename, e))
+
+def evict_cache():
+    # Drop the least recently used pages beyond g_cache_max_pages.
+    if g_cache_dir is None or not os.path.isdir(g_cache_dir):
+        return 0
+    keys = {}
+    for name in os.listdir(g_cache_dir):
+        path = os.path.join(g_cache_dir, name)
+        key = name.split(".")[0]
+        keys[key] = max(keys.get(key, 0), os.path.getmtime(path))
+    stale = sorted(keys, key=keys.get, reverse=True)[g_cache_max_pages:]
+    for name in os.listdir(g_cache_dir):
+        if name.split(".")[0] in stale:
+            os.remove(os.path.join(g_cache_dir, name))
+    return len(stale)
+
+
+def start_drawing(canvas, name, page):
+    canvas.drawing = canvas.backend()
+    canvas.drawing.start(canvas.out_dir)
+    canvas.warp(5, 10)
+    desc = g_cases[name][0] if name in g_cases else name
+    canvas.text("EVA 6mm foam templates for %s, pg %s" % (desc, page))
+
+# Pipelined conversion:
+#
+# rsvg-convert takes longer than drawing a page, so conversions run in
+# the background, g_convert_jobs at a time, while the next pages are
+# laid out and drawn.  Once that many more are waiting, drawing waits
+# for one to finish, so the SVGs on disk don't pile up.  draw_layout()
+# returns once all of its pages are done.
+
+g_convert_jobs = None  # Conversions at once, None for one per CPU, 0 to convert before drawing on.
+g_converter = None
+g_converter_lock = threading.Lock()
+
+class Converter:
+    def __init__(self, jobs):
+        self.pool = futures.ThreadPoolExecutor(jobs)
+        self.slots = threading.BoundedSemaphore(jobs * 2)
+
+    def submit(self, fn):
+        # Call fn() in the background.  Returns a future.
+        self.slots.acquire()
+
+        def convert():
+            try:
+                fn()
+            finally:
+                self.slots.release()
+
+        return self.pool.submit(convert)
+
+def converter():
+    global g_converter
+    with g_converter_lock:
+        if g_converter is None:
+            g_converter = Converter(g_convert_jobs or multiprocessing.cpu_count())
+        return g_converter
+
+def finish_rendering(canvas):
+    # Wait for the canvas's pending conversions, raising the first error.
+    (pending, canvas.pending) = (canvas.pending, [])
+    errors = [future.exception() for future in pending]
+    for error in errors:
+        if error is not None:
+            raise error
 
-def render(basename):
-    g_drawing.saveSvg("%s.svg" % basename)
-    cmd = "rsvg-convert -f pdf --dpi-x 600 --dpi-y 600 -o %s.pdf %s.svg" % (basename, basename)
-    subprocess.check_call(cmd, shell=True)
 
-def end_drawing(case, page):
-    draw_ruler()
-    render("%s_p%s" % (case, page))
+# Rendering to pages:
 
-def next_drawing(case, page):
-    end_drawing(case, page)
-    start_drawing(case, page+1)
+def render(canvas, basename, key=None):
+    canvas.rendered.append(basename)
+    page = canvas.drawing
+    exts = page_outputs(type(page))
+    store = key is not None and g_cache_dir is not None and len(exts) > 0
+    if store and not g_force:
+        with timed("cache-fetch", page=basename) as details:
+            details["hit"] = cache_fetch(exts, key, basename)
+        if details["hit"]:
+            page.cached(basename)
+            canvas.cache_hits += 1
+            return
+    with timed("write", page=basename) as details:
+        conversion = page.write(basename)
+        details["bytes"] = output_bytes(basename, exts)
+
+    def finish():
+        if conversion is not None:
+            with timed("convert", page=basename) as details:
+                run_conversion(conversion)
+                details["bytes"] = output_bytes(basename, ("pdf",))
+        if store:
+            cache_store(exts, key, basename)
+
+    if conversion is not None and g_convert_jobs != 0:
+        canvas.pending.append(converter().submit(finish))
+    else:
+        finish()
+
+def output_bytes(basename, exts):
+    paths = ["%s.%s" % (basename, ext) for ext in exts]
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def end_drawing(canvas, name, page, placements):
+    basename = os.path.join(canvas.out_dir, "%s_p%s" % (name, page))
+    render(canvas, basename, cache_key(canvas, name, page, placements))
+
+def draw_page(canvas, name, page, placements):
+    # Draw a whole page, ruler and all, without rendering it.
+    paths_drawn = canvas.paths_drawn
+    canvas.drawing = None
+    try:
+        with timed("draw", page="%s_p%s" % (name, page)) as details:
+            with timed("title"):
+                start_drawing(canvas, name, page)
+            with timed("parts", parts=len(placements)):
+                for placement in placements:
+                    draw_part(canvas, placement)
+            if canvas.drawing.ruler:
+                with timed("ruler"):
+                    draw_ruler(canvas)
+            details["paths"] = canvas.paths_drawn - paths_drawn
+    except BaseException:
+        # Don't leave a half drawn page's temporary file behind.
+        if canvas.drawing is not None:
+            canvas.drawing.discard()
+        raise
+    return canvas.drawing
+
+def draw_layout(canvas, name, pages):
+    if canvas.combine:
+        return draw_combined(canvas, name, [(name, pages)])
+    try:
+        for (i, placements) in enumerate(pages):
+            page = draw_page(canvas, name, i + 1, placements)
+            try:
+                end_drawing(canvas, name, i + 1, placements)
+            except BaseException:
+                page.discard()
+                raise
+    finally:
+        finish_rendering(canvas)
+    return len(pages)
+
+
+def draw_combined(canvas, basename, layouts):
+    # Draw every page of layouts, a list of (name, pages), then render
+    # them all at once into one "<basename>.pdf": one rsvg-convert call
+    # for all the SVGs, or one PDF sharing a single font.  No SVGs are
+    # kept.
+    drawn = []
+    keys = []
+    try:
+        for (name, pages) in layouts:
+            for (i, placements) in enumerate(pages):
+                drawn.append(draw_page(canvas, name, i + 1, placements))
+                keys.append(cache_key(canvas, name, i + 1, placements))
+    except BaseException:
+        for page in drawn:
+            page.discard()
+        raise
+    if len(drawn) == 0:
+        return 0
+    basename = os.path.join(canvas.out_dir, basename)
+    canvas.rendered.append(basename)
+    key = hashlib.sha256(repr(("combined", keys)).encode("utf-8")).hexdigest()
+    if g_cache_dir is not None and not g_force and cache_fetch(("pdf",), key, basename):
+        for page in drawn:
+            page.discard()
+        canvas.cache_hits += 1
+    else:
+        with timed("combine", pages=len(drawn)) as details:
+            canvas.drawing.combine(drawn, basename)
+            details["bytes"] = output_bytes(basename, ("pdf",))
+        if g_cache_dir is not None:
+            cache_store(("pdf",), key, basename)
+    return len(drawn)
+
+
+# Batch rendering:
+
+def lay_out(name, parts, layout=None):
+    if layout is None:
+        layout = g_layout
+    with timed("layout", name=name, parts=len(parts)) as details:
+        pages = g_layouts[layout](parts)
+        details["pages"] = len(pages)
+    return pages
+
+def draw_parts(name, parts, canvas=None, layout=None):
+    if canvas is None:
+        canvas = Canvas()
+    return draw_layout(canvas, name, lay_out(name, parts, layout))
+
+def draw_case(case, canvas=None, layout=None):
+    return draw_parts(case, case_parts(case), canvas, layout)
+
+
+# Orders:
+#
+# An order file lists the cases to cut foam for, one "<case> <quantity>"
+# per line.  Blank lines and anything after a "#" are ignored.
+
+def read_order(path):
+    order = []
+    with open(path) as f:
+        for (lineno, line) in enumerate(f, 1):
+            line = line.split("#")[0].strip()
+            if len(line) == 0:
+                continue
+            fields = line.split()
+            if len(fields) != 2 or not fields[1].isdigit():
+                raise ValueError("%s:%s: expected \"<case> <quantity>\", got %r" % (path, lineno, line))
+            if fields[0] not in g_cases:
+                raise ValueError("%s:%s: unknown case %s" % (path, lineno, fields[0]))
+            order.append((fields[0], int(fields[1])))
+    return order
+
+def order_parts(order):
+    return [part for (case, quantity) in order for _ in range(quantity) for part in case_parts(case)]
+
+def draw_nested(name, parts, canvas=None):
+    # Nest all the parts onto shared pages, reporting how full each
+    # page is and how long layout and rendering took.
+    if canvas is None:
+        canvas = Canvas()
+    start = time.time()
+    pages = lay_out(name, parts)
+    layout_seconds = time.time() - start
+    draw_layout(canvas, name, pages)
+    render_seconds = time.time() - start - layout_seconds
+    print_utilisation(name, pages)
+    print("Laid out %s parts on %s pages in %.2fs, rendered in %.2fs (%s cached)"
+          % (len(parts), len(pages), layout_seconds, render_seconds, canvas.cache_hits))
+    print("Part geometry: %s" % g_geometry.stats())
+    return len(pages)
+
+def draw_case_timed(case):
+    canvas = Canvas()
+    start = time.time()
+    with timed("case", case=case):
+        pages = draw_case(case, canvas)
+    return (case, pages, time.time() - start, canvas.cache_hits)
+
+def draw_case_profiled(case):
+    # In a worker process, return the stages recorded there as well.
+    return (draw_case_timed(case), g_profiler.take())
+
+# The globals which worker processes copy from the main process.
+g_worker_globals = (
+    "g_backend", "g_coalesce", "g_cache_dir", "g_force", "g_layout", "g_nest", "g_common_line",
+    "g_convert_jobs", "g_keep_svg", "g_combine", "g_job_times", "g_svgz", "g_svg_precision",
+)
+
+def init_worker(config, catalog_path, profile):
+    global g_cases, g_converter, g_profiler
+    globals().update(config)
+    if g_cases.path != catalog_path:
+        g_cases = Catalog(catalog_path)
+    g_converter = None  # Its threads weren't forked along with it.
+    g_profiler = Profiler() if profile else None
+
+def draw_cases(cases, jobs=None, threads=False):
+    # Each case renders independently (its own pages, its own rsvg-convert
+    # calls), so fan them out one worker per case.  Worker threads share
+    # this interpreter, worker processes don't.
+    if jobs is None:
+        jobs = min(len(cases), multiprocessing.cpu_count())
+    if threads:
+        load_lazy_modules()
+        with futures.ThreadPoolExecutor(max(jobs, 1)) as pool:
+            return list(pool.map(draw_case_timed, cases))
+    if jobs <= 1 or len(cases) <= 1:
+        return [draw_case_timed(case) for case in cases]
+    config = dict((name, globals()[name]) for name in g_worker_globals)
+    if g_convert_jobs != 0:
+        # Each worker has a converter of its own, so they share out the
+        # rsvg-convert processes rather than each running one per CPU.
+        config["g_convert_jobs"] = max(1, (g_convert_jobs or multiprocessing.cpu_count()) // jobs)
+    initargs = (config, g_cases.path, g_profiler is not None)
+    with multiprocessing.Pool(jobs, initializer=init_worker, initargs=initargs) as pool:
+        if g_profiler is None:
+            return pool.map(draw_case_timed, cases, chunksize=1)
+        results = []
+        for (result, events) in pool.map(draw_case_profiled, cases, chunksize=1):
+            results.append(result)
+            g_profiler.extend(events)
+        return results
+
+
+# Offcuts:
+#
+# --offcuts FILE keeps an inventory of foam offcuts as JSON:
+#
+#   {"next_id": 3, "offcuts": [{"id": 1, "outline": [[0, 0], [120, 0], ...]}, ...]}
+#
+# Outlines are simple polygons in mm, moved so their bounds start at
+# (0, 0).  Parts go into the smallest offcut they fit in, largest parts
+# first, before any fresh sheet is used.  Each offcut used is drawn as a
+# page of its own, the parts at the offcut's coordinates (offset to the
+# top left of the layout area, which also limits how much of a big
+# offcut is used).  What's left of it goes back into the inventory as
+# rectangles, clear of the parts and inside its outline.
+
+g_offcut_margin = 2  # mm kept clear of an offcut's edges, which are rarely straight.
+g_min_offcut = 20  # mm, narrower leftovers are thrown away.
+g_offcut_cell = 25  # mm, the size of OffcutIndex's cells.
+
+class Offcut:
+    def __init__(self, id, outline):
+        self.id = id
+        (min_x, min_y) = (min(x for (x, y) in outline), min(y for (x, y) in outline))
+        self.outline = [(x - min_x, y - min_y) for (x, y) in outline]
+        self.w = max(x for (x, y) in self.outline)
+        self.h = max(y for (x, y) in self.outline)
+        self.placed = []  # Placements in the offcut's coordinates.
+
+    def find(self, w, h):
+        # The lowest, then leftmost, (x, y, rotated) where a part with
+        # bounds w x h fits, or None.  Parts only ever touch the offcut's
+        # vertices or each other, so only positions against those are
+        # tried.
+        (area_x, area_y, area_w, area_h) = layout_area()
+        (limit_w, limit_h) = (min(self.w, area_w), min(self.h, area_h))
+        m = g_offcut_margin
+        rects = [placement_rect(placement) for placement in self.placed]
+        best = None
+        for (pw, ph, rotated) in ((w, h, False), (h, w, True)):
+            xs = set([x + m for (x, y) in self.outline] + [x - m - pw for (x, y) in self.outline]
+                     + [rx + rw + g_gap for (rx, ry, rw, rh) in rects] + [rx - g_gap - pw for (rx, ry, rw, rh) in rects])
+            ys = set([y + m for (x, y) in self.outline] + [y - m - ph for (x, y) in self.outline]
+                     + [ry + rh + g_gap for (rx, ry, rw, rh) in rects] + [ry - g_gap - ph for (rx, ry, rw, rh) in rects])
+            for y in sorted(ys):
+                if best is not None and y > best[1]:
+                    break
+                if y < 0 or y + ph > limit_h + 1e-9:
+                    continue
+                for x in sorted(xs):
+                    if x < 0 or x + pw > limit_w + 1e-9:
+                        continue
+                    if any(x < rx + rw + g_gap - 1e-9 and rx < x + pw + g_gap - 1e-9
+                           and y < ry + rh + g_gap - 1e-9 and ry < y + ph + g_gap - 1e-9 for (rx, ry, rw, rh) in rects):
+                        continue
+                    if rect_in_polygon((x - m, y - m, pw + 2 * m, ph + 2 * m), self.outline):
+                        if best is None or (y, x) < (best[1], best[0]):
+                            best = (x, y, rotated)
+                        break
+        return best
+
+    def page_placements(self):
+        (area_x, area_y, area_w, area_h) = layout_area()
+        return [(part, area_x + x, area_y + y, rotated) for (part, x, y, rotated) in self.placed]
+
+    def leftovers(self):
+        # What's left once the parts are cut out, as non-overlapping
+        # rectangles g_gap clear of the parts, largest first.  Whatever
+        # of the bounds is outside the outline is used up first, so the
+        # free rectangles are clipped to the outline rather than lost.
+        free = MaxRectsBin(self.w, self.h)
+        for (y0, y1, intervals) in polygon_strips(self.outline, g_min_offcut / 4):
+            x = 0
+            for (x0, x1) in intervals + [(self.w, self.w)]:
+                if x0 > x + 1e-9:
+                    free.insert(x, y0, x0 - x, y1 - y0)
+                x = x1
+        for (x, y, w, h) in map(placement_rect, self.placed):
+            free.insert(x - g_gap, y - g_gap, w + 2 * g_gap, h + 2 * g_gap)
+        big_enough = lambda rect: min(rect[2], rect[3]) >= g_min_offcut
+        rects = [rect for rect in free.free if big_enough(rect) and rect_in_polygon(rect, self.outline)]
+        pieces = []
+        while len(rects) > 0:
+            piece = max(rects, key=lambda rect: (rect[2] * rect[3], -rect[1], -rect[0]))
+            pieces.append(piece)
+            rects = [r for rect in rects for r in split_free_rect(rect, piece) if big_enough(r)]
+        return pieces
+
+def polygon_strips(polygon, step):
+    # The polygon's inside as horizontal strips, (y0, y1, [(x0, x1)]),
+    # where each interval is inside from y0 all the way to y1.  Strips
+    # with slanted edges are at most step high, a staircase inside them.
+    edges = list(zip(polygon, polygon[1:] + polygon[:1]))
+    ys = sorted(set(y for (x, y) in polygon))
+    strips = []
+    for (low, high) in zip(ys, ys[1:]):
+        slanted = any(ax != bx and min(ay, by) < high and max(ay, by) > low for ((ax, ay), (bx, by)) in edges)
+        n = int(math.ceil((high - low) / step)) if slanted else 1
+        for i in range(n):
+            (y0, y1) = (low + (high - low) * i / n, low + (high - low) * (i + 1) / n)
+            # Straight edges across the strip are furthest in at its ends.
+            intervals = intersect_intervals(polygon_intervals(edges, y0 + 1e-9), polygon_intervals(edges, y1 - 1e-9))
+            strips.append((y0, y1, intervals))
+    return strips
+
+def polygon_intervals(edges, y):
+    # The [(x0, x1)] inside the polygon along the line at y.
+    xs = sorted(ax + (y - ay) * (bx - ax) / (by - ay) for ((ax, ay), (bx, by)) in edges if (ay > y) != (by > y))
+    return list(zip(xs[0::2], xs[1::2]))
+
+def intersect_intervals(a, b):
+    both = [(max(a0, b0), min(a1, b1)) for (a0, a1) in a for (b0, b1) in b]
+    return sorted((x0, x1) for (x0, x1) in both if x1 > x0)
+
+def polygon_area(polygon):
+    return abs(sum(ax * by - bx * ay for ((ax, ay), (bx, by)) in zip(polygon, polygon[1:] + polygon[:1]))) / 2
+
+def rect_outline(x, y, w, h):
+    return [(x, y), (x + w, y), (x + w, y + h), (x, y + h)]
+
+def rect_in_polygon(rect, polygon):
+    # Whether the (x, y, w, h) rectangle is inside the polygon, a list
+    # of (x, y) points.  If none of the polygon's edges cross the
+    # rectangle's inside, it's all in or all out, so its centre decides.
+    (x, y, w, h) = rect
+    e = 1e-6
+    inside = (x + e, y + e, w - 2 * e, h - 2 * e)
+    edges = list(zip(polygon, polygon[1:] + polygon[:1]))
+    if any(segment_meets_rect(a, b, inside) for (a, b) in edges):
+        return False
+    return point_in_polygon((x + w / 2, y + h / 2), edges)
+
+def segment_meets_rect(a, b, rect):
+    # Liang-Barsky: clip the segment a-b to the rectangle.
+    (x, y, w, h) = rect
+    (dx, dy) = (b[0] - a[0], b[1] - a[1])
+    (t0, t1) = (0.0, 1.0)
+    for (p, q) in ((-dx, a[0] - x), (dx, x + w - a[0]), (-dy, a[1] - y), (dy, y + h - a[1])):
+        if p == 0:
+            if q < 0:
+                return False
+        elif p < 0:
+            t0 = max(t0, q / p)
+        else:
+            t1 = min(t1, q / p)
+    return t0 <= t1
+
+def point_in_polygon(point, edges):
+    # Even-odd rule, casting a ray in +x.
+    (px, py) = point
+    inside = False
+    for ((ax, ay), (bx, by)) in edges:
+        if (ay > py) != (by > py) and px < ax + (py - ay) * (bx - ax) / (by - ay):
+            inside = not inside
+    return inside
+
+class OffcutIndex:
+    # Offcuts in a grid by size: each goes in the cell (long side, short
+    # side) // g_offcut_cell, so finding the offcuts a part might fit in
+    # only looks into the cells at least as big as the part, not at every
+    # offcut in the inventory.
+
+    def __init__(self, offcuts=()):
+        self.cells = collections.defaultdict(list)
+        for offcut in offcuts:
+            self.add(offcut)
+
+    def cell(self, w, h):
+        return (int(max(w, h) // g_offcut_cell), int(min(w, h) // g_offcut_cell))
+
+    def add(self, offcut):
+        self.cells[self.cell(offcut.w, offcut.h)].append(offcut)
+
+    def query(self, w, h):
+        # The offcuts whose bounds could hold w x h either way round,
+        # smallest first.
+        (long_side, short_side) = (max(w, h), min(w, h))
+        (i, j) = self.cell(w, h)
+        found = [
+            offcut for ((ci, cj), offcuts) in self.cells.items() if ci >= i and cj >= j
+            for offcut in offcuts
+            if max(offcut.w, offcut.h) >= long_side and min(offcut.w, offcut.h) >= short_side
+        ]
+        return sorted(found, key=lambda offcut: (offcut.w * offcut.h, offcut.id))
+
+def place_in_offcuts(parts, offcuts):
+    # Put as many of the parts as fit into the offcuts, each with the
+    # parts nested in its cutouts.  Returns the parts left over.
+    contents = {}
+    if g_nest:
+        (parts, contents) = nest_in_holes(parts)
+    index = OffcutIndex(offcuts)
+    m = g_offcut_margin
+    area = lambda i: get_part_bounds(parts[i])[0] * get_part_bounds(parts[i])[1]
+    left = []
+    for i in sorted(range(len(parts)), key=lambda i: -area(i)):
+        (w, h) = get_part_bounds(parts[i])
+        for offcut in index.query(w + 2 * m, h + 2 * m):
+            fit = offcut.find(w, h)
+            if fit is not None:
+                placement = (parts[i],) + fit
+                offcut.placed.append(placement)
+                offcut.placed.extend(place_in_part(placement, inner) for inner in contents.get(i, []))
+                break
+        else:
+            left.append(i)
+    left.sort()
+    return [part for i in left for part in [parts[i]] + [inner[0] for inner in contents.get(i, [])]]
+
+def read_offcuts(path):
+    # Returns (next id, [Offcut]).  A missing file is an empty inventory.
+    if not os.path.exists(path):
+        return (1, [])
+    with open(path) as f:
+        data = json.load(f)
+    offcuts = []
+    for record in data["offcuts"]:
+        if len(record["outline"]) < 3:
+            raise ValueError("%s: offcut %s needs at least 3 points" % (path, record["id"]))
+        offcuts.append(Offcut(record["id"], [tuple(point) for point in record["outline"]]))
+    return (data["next_id"], offcuts)
+
+def write_offcuts(path, next_id, offcuts):
+    data = {
+        "next_id": next_id,
+        "offcuts": [
+            {"id": offcut.id, "outline": [[round(x, 3), round(y, 3)] for (x, y) in offcut.outline]}
+            for offcut in offcuts
+        ],
+    }
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+def add_offcuts(path, outlines):
+    (next_id, offcuts) = read_offcuts(path)
+    for outline in outlines:
+        offcuts.append(Offcut(next_id, outline))
+        print("Added offcut %s, %.1f x %.1f mm" % (next_id, offcuts[-1].w, offcuts[-1].h))
+        next_id += 1
+    write_offcuts(path, next_id, offcuts)
+
+def use_offcuts(name, parts, path, dry=False):
+    # Cut what fits from the inventory at path, then the rest from fresh
+    # sheets, and put the offcuts' leftovers back.
+    (next_id, offcuts) = read_offcuts(path)
+    start = time.time()
+    with timed("offcuts", name=name, parts=len(parts), offcuts=len(offcuts)):
+        left = place_in_offcuts(parts, offcuts)
+    used = [offcut for offcut in offcuts if len(offcut.placed) > 0]
+    for offcut in used:
+        page_name = "%s-offcut%s" % (name, offcut.id)
+        if dry:
+            print_utilisation(page_name, [offcut.page_placements()])
+        else:
+            draw_layout(Canvas(), page_name, [offcut.page_placements()])
+    print("Placed %s parts in %s of %s offcuts in %.3fs, %s parts left for fresh sheets"
+          % (len(parts) - len(left), len(used), len(offcuts), time.time() - start, len(left)))
+    if len(left) > 0:
+        if dry:
+            dry_run(name, left)
+        else:
+            draw_nested(name, left)
+    if dry:
+        return
+    kept = [offcut for offcut in offcuts if len(offcut.placed) == 0]
+    added = []
+    for offcut in used:
+        for rect in offcut.leftovers():
+            added.append(Offcut(next_id, rect_outline(*rect)))
+            next_id += 1
+    write_offcuts(path, next_id, kept + added)
+    print("Wrote %s offcuts (%s used up, %s leftovers added) to %s" % (len(kept) + len(added), len(used), len(added), path))
+
+
+# Server:
+#
+# --serve and --socket keep this process (with drawSvg, the catalog and
+# the geometry cache loaded) running and render requests as they come.
+# Requests and responses are JSON, one per line:
+#
+#   {"id": 1, "case": "1590B", "quantity": 2, "options": {"backend": "pdf"}}
+#   {"id": 1, "ok": true, "pages": 2, "files": ["1590B_p1.pdf", ...], "seconds": 0.01}
+#
+# Instead of "case" and "quantity", "order" may list [case, quantity]
+# pairs.  Options are backend, layout, coalesce, combine (one PDF for all
+# the pages), name (the output file prefix), dir (the output directory)
+# and inline (return the files' contents, base64 encoded, in "data", and
+# unless dir is given, don't keep them).  Requests writing the same
+# files are rendered one at a time.
+# {"command": "stats"} returns latency statistics.
+
+class LatencyStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=10000)
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) == 0:
+            return {"requests": 0}
+        return {
+            "requests": len(samples),
+            "mean": sum(samples) / len(samples),
+            "p50": samples[len(samples) // 2],
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            "max": samples[-1],
+        }
+
+g_latency = LatencyStats()
+
+def serve_render(request):
+    if request.get("command") == "stats":
+        return {"stats": g_latency.summary(), "geometry": g_geometry.stats()}
+    options = request.get("options", {})
+    if not isinstance(options, dict):
+        raise ValueError("options must be a JSON object")
+    if "order" in request:
+        order = [tuple(item) for item in request["order"]]
+    else:
+        order = [(request.get("case"), request.get("quantity", 1))]
+    for (case, quantity) in order:
+        if case not in g_cases:
+            raise ValueError("unknown case %s" % case)
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            raise ValueError("bad quantity %s for %s" % (quantity, case))
+    backend = options.get("backend", g_backend)
+    layout = options.get("layout", g_layout)
+    if backend not in g_backends:
+        raise ValueError("unknown backend %s" % backend)
+    if layout not in g_layouts:
+        raise ValueError("unknown layout %s" % layout)
+    if options.get("combine", g_combine) and not hasattr(g_backends[backend], "combine"):
+        raise ValueError("the %s backend can't write multi-page PDFs" % backend)
+    parts = order_parts(order)
+    check_parts_fit(parts, layout)
+    name = options.get("name", order[0][0] if len(order) == 1 else "order")
+    if os.path.basename(name) != name or name in ("", ".", ".."):
+        raise ValueError("bad name %s" % name)
+    canvas = Canvas(g_backends[backend], options.get("coalesce", g_coalesce), options.get("combine", g_combine))
+    canvas.out_dir = options.get("dir", "")
+    inline = options.get("inline", False)
+    if inline and "dir" not in options:
+        # Nobody needs the files on disk, so render into a directory of
+        # this request's own, where no other request can overwrite them.
+        canvas.out_dir = tempfile.mkdtemp(prefix=".serve-", dir=".")
+    try:
+        # Requests which write the same files take turns.
+        with output_lock(canvas.out_dir, name):
+            pages = draw_parts(name, parts, canvas, layout)
+            exts = ("pdf",) if canvas.combine else page_outputs(canvas.backend)
+            files = ["%s.%s" % (basename, ext) for basename in canvas.rendered for ext in exts]
+            response = {"pages": pages, "files": files, "cached": canvas.cache_hits}
+            if inline:
+                response["data"] = {}
+                for path in files:
+                    with open(path, "rb") as f:
+                        response["data"][os.path.basename(path)] = base64.b64encode(f.read()).decode("ascii")
+    finally:
+        if inline and "dir" not in options:
+            shutil.rmtree(canvas.out_dir, ignore_errors=True)
+    if inline and "dir" not in options:
+        response["files"] = [os.path.basename(path) for path in files]
+    return response
+
+g_output_locks = collections.defaultdict(threading.Lock)
+g_output_locks_lock = threading.Lock()
+
+def output_lock(out_dir, name):
+    with g_output_locks_lock:
+        return g_output_locks[(os.path.abspath(out_dir), name)]
+
+def handle_line(line):
+    start = time.perf_counter()
+    request = {}
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("expected a JSON object")
+        response = serve_render(request)
+        response["ok"] = True
+    except Exception as e:
+        # Every request gets a response, or its client waits forever.
+        response = {"ok": False, "error": str(e) or type(e).__name__}
+    if "id" in request:
+        response["id"] = request["id"]
+    response["seconds"] = time.perf_counter() - start
+    g_latency.record(response["seconds"])
+    return json.dumps(response) + "\n"
+
+def serve_stdin(jobs):
+    # Requests are handled by `jobs` threads, so responses may come back
+    # out of order; use "id" to match them up.
+    lock = threading.Lock()
+    load_lazy_modules()
+
+    def respond(line):
+        response = handle_line(line)
+        with lock:
+            sys.stdout.write(response)
+            sys.stdout.flush()
+
+    with futures.ThreadPoolExecutor(jobs) as pool:
+        for line in sys.stdin:
+            if line.strip():
+                pool.submit(respond, line)
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # Each connection is handled in its own thread, its requests in order.
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(handle_line(line.decode("utf-8")).encode("utf-8"))
+
+def serve_socket(path):
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise OSError("%s exists and isn't a socket" % path)
+        os.remove(path)
+    # Clean up the socket when we're told to stop, too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    load_lazy_modules()
+    with socketserver.ThreadingUnixStreamServer(path, RequestHandler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+# Profiling:
+#
+# With --profile, timed() records how long each stage of drawing and
+# rendering takes: layout, drawing each page (title, parts, ruler),
+# writing it, converting it and the cache.  Each stage is recorded with
+# the page and whatever counts it adds to its details dict (paths,
+# output bytes, cache hits).  Stages run in worker processes are sent
+# back with their results.  A summary is printed to stderr at exit,
+# and the stages are saved as a Chrome trace (FILE.json, see
+# chrome://tracing) or, for any other FILE, cProfile stats of the main
+# process are saved for pstats.
+
+g_profiler = None  # A Profiler while profiling.
+
+class Profiler:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, stage, started, seconds, details):
+        event = {
+            "name": stage, "ph": "X", "ts": started * 1e6, "dur": seconds * 1e6,
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": details,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def extend(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def take(self):
+        with self.lock:
+            (events, self.events) = (self.events, [])
+        return events
+
+    def summary(self):
+        # {stage: (count, total seconds, max seconds, total bytes)}
+        stages = {}
+        for event in self.events:
+            (count, total, longest, size) = stages.get(event["name"], (0, 0, 0, 0))
+            seconds = event["dur"] / 1e6
+            stages[event["name"]] = (
+                count + 1, total + seconds, max(longest, seconds), size + event["args"].get("bytes", 0)
+            )
+        return stages
+
+    def slowest_pages(self, n):
+        pages = {}
+        for event in self.events:
+            if "page" in event["args"] and event["name"] in ("draw", "write", "convert"):
+                pages[event["args"]["page"]] = pages.get(event["args"]["page"], 0) + event["dur"] / 1e6
+        return sorted(pages.items(), key=lambda item: item[1], reverse=True)[:n]
+
+@contextlib.contextmanager
+def timed(stage, **details):
+    # Record how long the with block takes as a stage.  The block may
+    # add to details.
+    if g_profiler is None:
+        yield details
+        return
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        yield details
+    finally:
+        g_profiler.record(stage, started, time.perf_counter() - start, details)
+
+def start_profiling(path):
+    global g_profiler
+    # Otherwise the first page's stages would include importing drawSvg
+    # (and cairo), making it look slow.
+    load_lazy_modules()
+    g_profiler = Profiler()
+    profile = None
+    if not path.endswith(".json"):
+        profile = cProfile.Profile()
+        profile.enable()
+    atexit.register(finish_profiling, path, profile)
+
+def finish_profiling(path, profile):
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(path)
+    else:
+        with open(path, "w") as f:
+            json.dump({"traceEvents": g_profiler.events, "displayTimeUnit": "ms"}, f)
+    sys.stderr.write("%-12s %6s %9s %9s %9s %10s\n" % ("stage", "count", "total s", "mean ms", "max ms", "bytes"))
+    for (stage, (count, total, longest, size)) in sorted(g_profiler.summary().items(), key=lambda item: -item[1][1]):
+        sys.stderr.write("%-12s %6s %9.3f %9.2f %9.2f %10s\n" % (stage, count, total, total / count * 1000, longest * 1000, size))
+    for (page, seconds) in g_profiler.slowest_pages(5):
+        sys.stderr.write("slow page %s: %.3fs\n" % (page, seconds))
+    sys.stderr.write("Profile written to %s\n" % path)
+
+
+# Queries:
+#
+# --list, --bounds and --dry-run answer questions about the catalog and
+# layout without drawing anything, so they run without loading drawSvg
+# or NumPy.
+
+def list_cases(cases):
+    for case in cases:
+        c = g_cases[case]
+        print("%-14s %-40s top %s x %s, bottom %s x %s, height %s, notch %s"
+              % (case, c.desc, c.top_len, c.top_width, c.bottom_len, c.bottom_width, c.height, c.notch))
+
+def print_bounds(case):
+    for kind in g_part_kinds:
+        count = case_parts(case).count((kind, case))
+        (w, h) = get_part_bounds((kind, case))
+        print("%s %s: %.2f x %.2f mm (x%s)" % (case, kind, w, h, count))
+
+def print_utilisation(name, pages):
+    for (i, placements) in enumerate(pages):
+        print("%s_p%s: %s parts, %.0f%% used" % (name, i + 1, len(placements), page_utilisation(placements) * 100))
+    nested = sum(len(nested_placements(placements)) for placements in pages)
+    if nested > 0:
+        print("Nested %s parts in cutouts, reclaiming %.0f cm2 of foam"
+              % (nested, sum(nested_area(placements) for placements in pages) / 100))
+
+def dry_run(name, parts):
+    start = time.time()
+    pages = g_layouts[g_layout](parts)
+    seconds = time.time() - start
+    print_utilisation(name, pages)
+    print("Laid out %s parts on %s pages in %.3fs" % (len(parts), len(pages), seconds))
+
+
+# Self-check:
+
+def check_geometry():
+    # Draw every case with and without path coalescing and make sure
+    # both produce exactly the same line segments, and that each of its
+    # parts' outlines match the part's reference drawing.
+    ok = True
+    for case in g_cases:
+        results = []
+        for coalesce in (False, True):
+            pages = {}
+            canvas = Canvas(lambda: RecordingPage(pages), coalesce, False)
+            draw_case(case, canvas)
+            results.append(pages)
+        same = results[0] == results[1]
+        wrong = [kind for (kind, _) in dict.fromkeys(case_parts(case)) if not matches_reference((kind, case))]
+        segments = sum(len(page) for page in results[0].values())
+        print("%s: %s (%s segments)" % (case, "ok" if same and not wrong else
+                                        "MISMATCH" + "".join(" %s" % kind for kind in wrong), segments))
+        ok = ok and same and not wrong
+    return ok
+
+def matches_reference(part):
+    # Whether the part's outlines, drawn either way, have the segments
+    # its reference drawing has.
+    (kind, case) = part
+    pages = {}
+    for (basename, coalesce) in (("reference", False), ("segments", False), ("paths", True)):
+        canvas = Canvas(lambda: RecordingPage(pages), coalesce, False)
+        canvas.drawing = canvas.backend()
+        if basename == "reference":
+            g_reference_parts[kind](canvas, case)
+        else:
+            draw_outlines_at(canvas, 0, 0, get_part_outlines(part))
+        canvas.drawing.render(basename)
+    reference = np.array(pages["reference"])
+    return all(reference.shape == np.shape(pages[basename]) and np.allclose(reference, pages[basename], atol=1e-6)
+               for basename in ("segments", "paths"))
+
+# Reference drawings:
+#
+# Each part drawn at (0, 0) as the relative pen moves the templates were
+# first drawn with, one segment at a time.  check_geometry() compares
+# the outline arrays against these, which don't share any code with them.
+
+def reference_top(canvas, case):
+    (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
+    canvas.warp(0, 0)
+    canvas.move(g_foam_thick + notch, 0)
+    canvas.pen_down()
+    canvas.move(top_len - notch - notch, 0)
+    canvas.move(0, g_foam_thick + notch)
+    canvas.move(g_foam_thick + notch, 0)
+    canvas.move(0, top_width - notch - notch)
+    canvas.move(-(g_foam_thick + notch), 0)
+    canvas.move(0, g_foam_thick + notch)
+    canvas.move(-(top_len - notch - notch), 0)
+    canvas.move(0, -(g_foam_thick + notch))
+    canvas.move(-(g_foam_thick + notch), 0)
+    canvas.move(0, -(top_width - notch - notch))
+    canvas.move(g_foam_thick + notch, 0)
+    canvas.move(0, -(g_foam_thick + notch))
+    canvas.pen_up()
+
+def reference_end(canvas, case):
+    (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
+    canvas.warp(0, 0)
+    canvas.pen_down()
+    canvas.move(top_width + g_foam_thick * 2, 0)
+    canvas.move(-((top_width - bottom_width) / 2), height)
+    canvas.move(-(bottom_width + g_foam_thick * 2), 0)
+    canvas.move(-((top_width - bottom_width) / 2), -height)
+    canvas.pen_up()
+
+def reference_side(canvas, case):
+    (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
+    canvas.warp(0, 0)
+    canvas.pen_down()
+    canvas.move(top_len + g_foam_thick * 2, 0)
+    canvas.move(-((top_len - bottom_len) / 2), height)
+    canvas.move(-(bottom_len + g_foam_thick * 2), 0)
+    canvas.move(-((top_len - bottom_len) / 2), -height)
+    canvas.pen_up()
+
+def reference_bottom(canvas, case, center_cutout=False):
+    (desc, top_len, top_width, bottom_len, bottom_width, height, notch) = g_cases[case]
+    canvas.warp(0, 0)
+    canvas.pen_down()
+    canvas.move(bottom_len + g_foam_thick * 2, 0)
+    canvas.move(0, bottom_width + g_foam_thick * 2)
+    canvas.move(-(bottom_len + g_foam_thick * 2), 0)
+    canvas.move(0, -(bottom_width + g_foam_thick * 2))
+    if center_cutout:
+        margin = g_cutout_margin
+        canvas.warp(g_foam_thick + margin, g_foam_thick + margin)
+        canvas.move(bottom_len - margin * 2, 0)
+        canvas.move(0, bottom_width - margin * 2)
+        canvas.move(-(bottom_len - margin * 2), 0)
+        canvas.move(0, -(bottom_width - margin * 2))
+    canvas.pen_up()
+
+g_reference_parts = {
+    "top": reference_top,
+    "end": reference_end,
+    "side": reference_side,
+    "bottom_cutout": lambda canvas, case: reference_bottom(canvas, case, center_cutout=True),
+    "bottom": reference_bottom,
+}
+
+def check_layouts():
+    # Make sure every layout keeps parts inside the page area and apart,
+    # or g_gap inside another's cutout, and that every part is drawn
+    # inside its bounds.
+    (area_x, area_y, area_w, area_h) = layout_area()
+    gap = part_gap()
+    e = 1e-9
+    nested_in = lambda inner, host: any(
+        rect_contains((hx + g_gap - e, hy + g_gap - e, hw - 2 * g_gap + 2 * e, hh - 2 * g_gap + 2 * e), placement_rect(inner))
+        for (hx, hy, hw, hh) in placement_holes(host)
+    )
+    ok = True
+    for (name, parts) in [(case, case_parts(case)) for case in g_cases] + [("all cases", all_parts())]:
+        for layout in sorted(g_layouts):
+            pages = g_layouts[layout](parts)
+            problems = 0
+            for placements in pages:
+                rects = [placement_rect(placement) for placement in placements]
+                for (placement, (x, y, w, h)) in zip(placements, rects):
+                    # The drawn outlines must fill the part's bounds exactly.
+                    points = np.concatenate(place_outlines(placement))
+                    if not np.allclose((points.min(axis=0), points.max(axis=0)), ((x, y), (x + w, y + h))):
+                        problems += 1
+                for (i, (x, y, w, h)) in enumerate(rects):
+                    if x < area_x or y < area_y or x + w > area_x + area_w + 1e-9:
+                        problems += 1
+                    if layout != "stack" and y + h > area_y + area_h + 1e-9:
+                        problems += 1
+                    for (j, (ox, oy, ow, oh)) in enumerate(rects[:i]):
+                        if nested_in(placements[i], placements[j]) or nested_in(placements[j], placements[i]):
+                            continue
+                        if (x < ox + ow + gap - 1e-9 and ox < x + w + gap - 1e-9
+                                and y < oy + oh + gap - 1e-9 and oy < y + h + gap - 1e-9):
+                            problems += 1
+            placed = sum(len(placements) for placements in pages)
+            if placed != len(parts):
+                problems += 1
+            nested = sum(len(nested_placements(placements)) for placements in pages)
+            print("%s, %s layout: %s (%s pages, %s nested)"
+                  % (name, layout, "ok" if problems == 0 else "%s PROBLEMS" % problems, len(pages), nested))
+            ok = ok and problems == 0
+    return ok
+
+def check_svg_writers():
+    # The streaming SVG writer must write exactly what drawSvg does.
+    ok = True
+    for case in g_cases:
+        pages = g_layouts[g_layout](case_parts(case))
+        same = True
+        for (i, placements) in enumerate(pages):
+            expected = draw_page(Canvas(SvgPage), case, i + 1, placements).get_drawing().asSvg()
+            path = draw_page(Canvas(StreamingSvgPage), case, i + 1, placements).finish()
+            with open(path, encoding="utf-8") as f:
+                same = same and f.read() == expected
+            os.remove(path)
+        print("%s, streaming SVG: %s" % (case, "ok" if same else "MISMATCH"))
+        ok = ok and same
+    return ok
+
+def check_compact_svg():
+    # The compact SVG's paths and uses must decode to the page's points,
+    # rounded to g_svg_precision.
+    ok = True
+    for case in g_cases:
+        same = True
+        (size, compact_size) = (0, 0)
+        for (i, placements) in enumerate(g_layouts[g_layout](case_parts(case))):
+            page = draw_page(Canvas(CompactSvgPage), case, i + 1, placements)
+            svg = page.svg()
+            expected = [(svg_units(mm_to_px(points)).tolist(), c) for (points, c) in zip(page.paths, page.closed)]
+            same = same and sorted(parse_compact_svg(svg)) == sorted(expected)
+            size += len(draw_page(Canvas(SvgPage), case, i + 1, placements).svg())
+            compact_size += len(svg)
+        print("%s, compact SVG: %s (%.0f%% of the size)" % (case, "ok" if same else "MISMATCH", compact_size * 100 / size))
+        ok = ok and same
+    return ok
+
+def check_offcuts():
+    # Parts placed in offcuts must be inside the outlines, g_offcut_margin
+    # clear of their edges and g_gap apart (or nested), and the leftovers
+    # inside the outlines and clear of the parts.  The index must find
+    # what looking at every offcut finds.
+    outlines = [
+        rect_outline(0, 0, 150, 100), rect_outline(0, 0, 60, 200), rect_outline(0, 0, 30, 30),
+        [(0, 0), (180, 0), (180, 60), (80, 60), (80, 140), (0, 140)],  # An L.
+        [(0, 0), (250, 0), (0, 150)],  # A triangle.
+    ]
+    offcuts = [Offcut(i + 1, outline) for (i, outline) in enumerate(outlines)]
+    parts = all_parts()
+    left = place_in_offcuts(parts, offcuts)
+    problems = 0 if len(left) + sum(len(offcut.placed) for offcut in offcuts) == len(parts) else 1
+    m = g_offcut_margin
+    for offcut in offcuts:
+        rects = [placement_rect(placement) for placement in offcut.placed]
+        nested = nested_placements(offcut.placed)
+        for (i, (x, y, w, h)) in enumerate(rects):
+            if offcut.placed[i] not in nested and not rect_in_polygon((x - m, y - m, w + 2 * m, h + 2 * m), offcut.outline):
+                problems += 1
+            for (j, (ox, oy, ow, oh)) in enumerate(rects[:i]):
+                if offcut.placed[i] in nested or offcut.placed[j] in nested:
+                    continue
+                if x < ox + ow + g_gap - 1e-9 and ox < x + w + g_gap - 1e-9 and y < oy + oh + g_gap - 1e-9 and oy < y + h + g_gap - 1e-9:
+                    problems += 1
+        pieces = offcut.leftovers()
+        for (i, piece) in enumerate(pieces):
+            if not rect_in_polygon(piece, offcut.outline):
+                problems += 1
+            if any(rects_overlap(piece, rect) for rect in rects + pieces[:i]):
+                problems += 1
+        # What's kept and what's cut should add up to most of the offcut:
+        # only gaps, margins and slivers narrower than g_min_offcut go.
+        kept = sum(w * h for (x, y, w, h) in pieces + [placement_rect(p) for p in offcut.placed if p not in nested])
+        if len(offcut.placed) > 0 and kept < 0.6 * polygon_area(offcut.outline):
+            problems += 1
+    index = OffcutIndex(offcuts)
+    for (w, h) in [(20, 20), (40, 120), (120, 40), (100, 100), (151, 10), (250, 150), (300, 300)]:
+        everywhere = [offcut for offcut in offcuts if max(offcut.w, offcut.h) >= max(w, h) and min(offcut.w, offcut.h) >= min(w, h)]
+        if sorted(offcut.id for offcut in index.query(w, h)) != sorted(offcut.id for offcut in everywhere):
+            problems += 1
+    used = len([offcut for offcut in offcuts if len(offcut.placed) > 0])
+    print("offcuts: %s (%s parts in %s offcuts)"
+          % ("ok" if problems == 0 else "%s PROBLEMS" % problems, len(parts) - len(left), used))
+    return problems == 0
+
+def check_common_lines():
+    # With common lines, the cutter paths must cover every stretch of
+    # every edge that was drawn, and cover it only once.
+    global g_common_line
+    setting = g_common_line
+    g_common_line = True
+    ok = True
+    try:
+        for case in g_cases:
+            same = True
+            (drawn_length, cut_length) = (0, 0)
+            for (i, placements) in enumerate(g_layouts[g_layout](case_parts(case))):
+                page = draw_page(Canvas(HpglPage), case, i + 1, placements)
+                paths = transform_paths(page.paths, page_to_mm)
+                (covered, length) = line_coverage(paths, page.closed)
+                (merged_covered, merged_length) = line_coverage(*merge_common_lines(paths, page.closed))
+                merged_union = sum(t1 - t0 for intervals in merged_covered.values() for (t0, t1) in intervals)
+                same = same and merged_covered == covered and abs(merged_length - merged_union) < 0.01 * len(paths)
+                (drawn_length, cut_length) = (drawn_length + length, cut_length + merged_length)
+            print("%s, common lines: %s (%.0f%% less cutting)"
+                  % (case, "ok" if same else "MISMATCH", (drawn_length - cut_length) * 100 / drawn_length))
+            ok = ok and same
+    finally:
+        g_common_line = setting
+    return ok
+
+def check_cutting_order():
+    # Every path inside a closed path must be cut before it, with and
+    # without common lines.
+    global g_common_line
+    setting = g_common_line
+    ok = True
+    try:
+        for case in g_cases:
+            (pairs, wrong) = (0, 0)
+            for g_common_line in (False, True):
+                for (i, placements) in enumerate(g_layouts[g_layout](case_parts(case))):
+                    page = draw_page(Canvas(HpglPage), case, i + 1, placements)
+                    tool_paths = page.tool_paths()
+                    inside = path_containment([np.array(points) for (points, c) in tool_paths], [c for (points, c) in tool_paths])
+                    (inner, outer) = np.nonzero(inside)
+                    pairs += len(inner)
+                    wrong += int(np.sum(inner > outer))
+            print("%s, cutting order: %s (%s paths inside others)" % (case, "ok" if wrong == 0 else "%s WRONG" % wrong, pairs))
+            ok = ok and wrong == 0
+    finally:
+        g_common_line = setting
+    return ok
+
+def line_coverage(paths, closed):
+    # ({line: [(t0, t1)] covered, rounded to 0.01mm}, total edge length).
+    spans = collections.defaultdict(list)
+    length = 0
+    for (points, c) in zip(paths, closed):
+        points = points.tolist()
+        loop = points + points[:1] if c else points
+        for (a, b) in zip(loop, loop[1:]):
+            key = line_key(a, b)
+            if key is not None:
+                spans[key[0]].append((min(key[1:]), max(key[1:])))
+                length += abs(key[2] - key[1])
+    covered = {}
+    for (line, intervals) in spans.items():
+        union = []
+        for (t0, t1) in sorted(intervals):
+            if len(union) > 0 and t0 <= union[-1][1] + 1e-6:
+                union[-1] = (union[-1][0], max(union[-1][1], t1))
+            else:
+                union.append((t0, t1))
+        covered[line] = [(round(t0, 2), round(t1, 2)) for (t0, t1) in union]
+    return (covered, length)
+
+def rects_overlap(a, b):
+    return a[0] < b[0] + b[2] - 1e-9 and b[0] < a[0] + a[2] - 1e-9 and a[1] < b[1] + b[3] - 1e-9 and b[1] < a[1] + a[3] - 1e-9
+
+def parse_compact_svg(svg):
+    # The [(points, closed)] drawn by CompactSvgPage.svg(), with each
+    # <use> expanded.
+    symbols = dict((id, parse_path_data(d)[0]) for (id, d) in re.findall(r'<path id="(\w+)" d="([^"]*)"', svg))
+    paths = []
+    for d in re.findall(r'<path d="([^"]*)"', svg):
+        paths += parse_path_data(d)
+    for (id, x, y) in re.findall(r'<use xlink:href="#(\w+)" x="([^"]*)" y="([^"]*)"', svg):
+        (dx, dy) = (int(round(float(x) * 10 ** g_svg_precision)), int(round(float(y) * 10 ** g_svg_precision)))
+        (points, closed) = symbols[id]
+        paths.append(([[px + dx, py + dy] for (px, py) in points], closed))
+    return paths
+
+def parse_path_data(d):
+    # The [(points, closed)] which compact_path_data() wrote as d.
+    tokens = re.findall(r"[MmhvlzZ]|-?(?:\d+\.?\d*|\.\d+)", d)
+    numbers = lambda n: [int(round(float(tokens.pop(0)) * 10 ** g_svg_precision)) for _ in range(n)]
+    paths = []
+    at = (0, 0)
+    while tokens:
+        command = tokens.pop(0)
+        if command in "Mm":
+            (x, y) = numbers(2)
+            if command == "m":
+                (x, y) = (at[0] + x, at[1] + y)
+            paths.append(([[x, y]], False))
+        elif command == "z":
+            paths[-1] = (paths[-1][0], True)
+        else:
+            (dx, dy) = {"h": lambda: numbers(1) + [0], "v": lambda: [0] + numbers(1), "l": lambda: numbers(2)}[command]()
+            (x, y) = paths[-1][0][-1]
+            paths[-1][0].append([x + dx, y + dy])
+        points = paths[-1][0]
+        at = points[0] if paths[-1][1] else points[-1]
+    return paths
+
+def all_parts():
+    return [part for case in g_cases for part in case_parts(case)]
 
 
 # Main:
 
+def parse_range(arg):
+    # "height=30:40" -> ("height", (30.0, 40.0)), either end may be empty.
+    (field, sep, bounds) = arg.partition("=")
+    (low, colon, high) = bounds.partition(":")
+    if not colon:
+        high = low
+    try:
+        return (field, (float(low) if low else None, float(high) if high else None))
+    except ValueError:
+        raise ValueError("bad range %s, expected DIM=MIN:MAX" % arg)
+
+def parse_outline(arg):
+    # "120x80" -> a rectangle, "x,y x,y x,y ..." -> a polygon, in mm.
+    try:
+        if "x" in arg:
+            (w, h) = [float(n) for n in arg.split("x")]
+            return rect_outline(0, 0, w, h)
+        outline = [tuple(float(n) for n in point.split(",")) for point in arg.split()]
+        if len(outline) >= 3 and all(len(point) == 2 for point in outline):
+            return outline
+    except ValueError:
+        pass
+    raise ValueError("bad offcut %s, expected WxH or \"x,y x,y x,y ...\"" % arg)
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Draw EVA foam templates for Hammond aluminum cases."
+    )
+    parser.add_argument(
+        "cases", nargs="*", metavar="case",
+        help="case(s) to render (default: 1590A-tayda)"
+    )
+    parser.add_argument(
+        "--all", action="store_true",
+        help="render every case in g_cases"
+    )
+    parser.add_argument(
+        "--catalog", metavar="FILE",
+        help="load cases from a CSV or JSON catalog (default: cases.csv next to this script)"
+    )
+    parser.add_argument(
+        "--where", metavar="DIM=MIN:MAX", action="append",
+        help="render every case with a dimension in a range, e.g. height=:35 or top_len=100:120 (may be repeated)"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="number of worker processes (default: one per case, up to the CPU count)"
+    )
+    parser.add_argument(
+        "--threads", action="store_true",
+        help="render cases in worker threads instead of worker processes"
+    )
+    parser.add_argument(
+        "--backend", choices=sorted(g_backends), default=g_backend,
+        help="rsvg: write SVG and convert with rsvg-convert (default); "
+             "stream: the same, but write the SVG as it is drawn; "
+             "compact: the same, but write a smaller SVG; pdf: write PDF directly; "
+             "dxf, hpgl: write cutter tool paths"
+    )
+    parser.add_argument(
+        "--layout", choices=sorted(g_layouts), default=g_layout,
+        help="pack: fit parts onto as few pages as possible (default); stack: one column per page"
+    )
+    parser.add_argument(
+        "--no-nest", dest="nest", action="store_false",
+        help="with the pack layout, don't nest parts in the cutouts of other parts"
+    )
+    parser.add_argument(
+        "--common-line", action="store_true",
+        help="with the pack layout, put parts edge to edge, and with the dxf and hpgl backends, "
+             "cut the edges they share once and report the cutting saved"
+    )
+    parser.add_argument(
+        "--convert-jobs", type=int, default=g_convert_jobs, metavar="N",
+        help="run up to N rsvg-convert processes in the background while drawing "
+             "(default: one per CPU, 0 converts each page before drawing the next)"
+    )
+    parser.add_argument(
+        "--no-svg", dest="keep_svg", action="store_false",
+        help="only write PDFs: pipe each page's SVG to rsvg-convert instead of saving it"
+    )
+    parser.add_argument(
+        "--svgz", action="store_true",
+        help="save SVGs gzipped, as .svgz"
+    )
+    parser.add_argument(
+        "--svg-precision", type=int, default=g_svg_precision, metavar="N",
+        help="decimal places of a px in the compact backend's coordinates (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--single-pdf", dest="combine", action="store_true",
+        help="write each case's pages (or --together's or --order's) into one multi-page NAME.pdf, without SVGs"
+    )
+    parser.add_argument(
+        "--batch-pdf", metavar="FILE",
+        help="write the pages of every case into one multi-page PDF, without SVGs"
+    )
+    parser.add_argument(
+        "--job-times", action="store_true",
+        help="with the dxf and hpgl backends, print each page's estimated cutting time "
+             "before and after optimising the tool paths"
+    )
+    parser.add_argument(
+        "--together", metavar="NAME",
+        help="lay out the parts of all the cases together, on pages named NAME_pN"
+    )
+    parser.add_argument(
+        "--order", metavar="FILE",
+        help="nest the parts for an order file of \"<case> <quantity>\" lines onto shared pages"
+    )
+    parser.add_argument(
+        "--offcuts", metavar="FILE",
+        help="with --order or --together, cut what fits from the offcut inventory in FILE first, "
+             "and write the leftovers back to it"
+    )
+    parser.add_argument(
+        "--add-offcut", metavar="OUTLINE", action="append",
+        help="add an offcut, WxH or \"x,y x,y x,y ...\" in mm, to the --offcuts inventory and exit (may be repeated)"
+    )
+    parser.add_argument(
+        "--serve", action="store_true",
+        help="render JSON-lines requests from stdin until EOF, see \"Server\" in the source"
+    )
+    parser.add_argument(
+        "--socket", metavar="PATH",
+        help="like --serve, but accept connections on a Unix socket"
+    )
+    parser.add_argument(
+        "--no-coalesce", dest="coalesce", action="store_false",
+        help="draw every segment as its own line instead of one path per outline"
+    )
+    parser.add_argument(
+        "--force", action="store_true",
+        help="re-render every page, even if it is in the cache"
+    )
+    parser.add_argument(
+        "--cache-dir", default=g_cache_dir,
+        help="where rendered pages are cached (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--no-cache", dest="cache_dir", action="store_const", const=None,
+        help="don't read or write the cache"
+    )
+    parser.add_argument(
+        "--list", action="store_true",
+        help="list the cases in the catalog (or those matching --where) and exit"
+    )
+    parser.add_argument(
+        "--bounds", action="store_true",
+        help="print the size of each part of the cases and exit"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="lay out the pages and print how full they are, without drawing them"
+    )
+    parser.add_argument(
+        "--profile", metavar="FILE",
+        help="time each stage of every page and print a summary; save a Chrome trace to FILE.json, "
+             "or cProfile stats of this process (not worker processes) to any other FILE"
+    )
+    parser.add_argument(
+        "--check", action="store_true",
+        help="check that the part outlines match their reference drawings with and without path "
+             "coalescing, that layouts and offcuts don't "
+             "overlap, that the SVG writers agree, that common lines are cut once and that cutouts are "
+             "cut before the outlines around them, then exit"
+    )
+    args = parser.parse_args(argv)
+    global g_cases
+    if args.catalog is not None:
+        g_cases = Catalog(args.catalog)
+    try:
+        g_cases.load()
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.where is not None:
+        try:
+            args.cases = g_cases.query(**dict(parse_range(arg) for arg in args.where))
+        except ValueError as e:
+            parser.error(str(e))
+        if len(args.cases) == 0:
+            parser.error("no cases match")
+    elif args.all:
+        args.cases = list(g_cases.keys())
+    elif len(args.cases) == 0 and not (args.list or args.check or args.serve or args.socket is not None
+                                       or args.add_offcut is not None or args.order is not None):
+        # Only when the cases are drawn: the catalog may not have this one.
+        args.cases = ["1590A-tayda"]
+    # A case named twice would be drawn twice at once, into the same files.
+    args.cases = list(dict.fromkeys(args.cases))
+    if args.svg_precision < 0:
+        parser.error("--svg-precision can't be negative")
+    if args.add_offcut is not None:
+        if args.offcuts is None:
+            parser.error("--add-offcut needs --offcuts")
+        try:
+            args.add_offcut = [parse_outline(arg) for arg in args.add_offcut]
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.offcuts is not None and args.order is None and args.together is None:
+        parser.error("--offcuts needs --order or --together")
+    if (args.combine or args.batch_pdf is not None) and not hasattr(g_backends[args.backend], "combine"):
+        parser.error("the %s backend can't write multi-page PDFs" % args.backend)
+    for case in args.cases:
+        if case not in g_cases:
+            parser.error("unknown case %s (choose from %s)" % (case, ", ".join(g_cases)))
+        if not (args.list or args.bounds):
+            try:
+                check_parts_fit(case_parts(case), args.layout)
+            except ValueError as e:
+                parser.error(str(e))
+    return args
+
 if __name__ == "__main__":
-    case = "1590A-tayda"
-    if len(sys.argv) > 1:
-        case = sys.argv[-1]
-
-    page = 1
-    start_drawing(case, page)
-    x = 5; y = 15
-
-    top_bounds = get_top_bounds_h(case)
-    end_bounds = get_end_bounds_h(case)
-    side_bounds = get_side_bounds_h(case)
-    bottom_bounds = get_bottom_bounds_h(case)
-
-    draw_top_h(x, y, case)
-    y += top_bounds[1] + 5
-
-    if y + end_bounds[1] >= bottom() - 20:
-        next_drawing(case, page); page += 1; y = 15
-    draw_end_h(x, y, case)
-    y += end_bounds[1] + 5
-
-    if y + end_bounds[1] >= bottom() - 20:
-        next_drawing(case, page); page += 1; y = 15
-    draw_end_h(x, y, case)
-    y += end_bounds[1] + 5
-
-    if y + side_bounds[1] >= bottom() - 20:
-        next_drawing(case, page); page += 1; y = 15
-    draw_side_h(x, y, case)
-    y += side_bounds[1] + 5
-
-    if y + side_bounds[1] >= bottom() - 20:
-        next_drawing(case, page); page += 1; y = 15
-    draw_side_h(x, y, case)
-    y += side_bounds[1] + 5
-
-    if y + bottom_bounds[1] >= bottom() - 20:
-        next_drawing(case, page); page += 1; y = 15
-    draw_bottom_h(x, y, case, center_cutout=True)
-    y += bottom_bounds[1] + 5
-
-    if y + bottom_bounds[1] >= bottom() - 20:
-        next_drawing(case, page); page += 1; y = 15
-    draw_bottom_h(x, y, case, center_cutout=True)
-    y += bottom_bounds[1] + 5
-
-    if y + bottom_bounds[1] >= bottom() - 20:
-        next_drawing(case, page); page += 1; y = 15
-    draw_bottom_h(x, y, case)
-    y += bottom_bounds[1] + 5
-
-    end_drawing(case, page)
+    args = parse_args(sys.argv[1:])
+    g_backend = args.backend
+    g_coalesce = args.coalesce
+    g_layout = args.layout
+    g_nest = args.nest
+    g_common_line = args.common_line
+    g_cache_dir = args.cache_dir
+    g_force = args.force
+    g_convert_jobs = args.convert_jobs
+    g_keep_svg = args.keep_svg
+    g_combine = args.combine
+    g_job_times = args.job_times
+    g_svgz = args.svgz
+    g_svg_precision = args.svg_precision
+    if args.profile is not None:
+        start_profiling(args.profile)
+
+    if args.list:
+        list_cases(args.cases if args.where is not None else g_cases)
+        sys.exit(0)
+
+    if args.bounds:
+        for case in args.cases:
+            print_bounds(case)
+        sys.exit(0)
+
+    if args.check:
+        ok = check_geometry()
+        ok = check_layouts() and ok
+        ok = check_svg_writers() and ok
+        ok = check_compact_svg() and ok
+        ok = check_offcuts() and ok
+        ok = check_common_lines() and ok
+        ok = check_cutting_order() and ok
+        sys.exit(0 if ok else 1)
+
+    if args.serve or args.socket is not None:
+        try:
+            if args.socket is not None:
+                serve_socket(args.socket)
+            else:
+                serve_stdin(args.jobs or multiprocessing.cpu_count())
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        sys.stderr.write("Served %s\n" % json.dumps(g_latency.summary()))
+        sys.exit(0)
+
+    if args.add_offcut is not None:
+        try:
+            add_offcuts(args.offcuts, args.add_offcut)
+        except (OSError, ValueError, KeyError) as e:
+            sys.exit("error: %s" % e)
+        sys.exit(0)
+
+    if args.offcuts is not None:
+        try:
+            if args.order is not None:
+                parts = order_parts(read_order(args.order))
+                name = args.together or os.path.splitext(os.path.basename(args.order))[0]
+            else:
+                parts = [part for case in args.cases for part in case_parts(case)]
+                name = args.together
+            use_offcuts(name, parts, args.offcuts, args.dry_run)
+        except (OSError, ValueError, KeyError) as e:
+            sys.exit("error: %s" % e)
+        evict_cache()
+        sys.exit(0)
+
+    if args.order is not None:
+        try:
+            parts = order_parts(read_order(args.order))
+            check_parts_fit(parts)
+        except (OSError, ValueError) as e:
+            sys.exit("error: %s" % e)
+        name = args.together or os.path.splitext(os.path.basename(args.order))[0]
+        if args.dry_run:
+            dry_run(name, parts)
+            sys.exit(0)
+        draw_nested(name, parts)
+        evict_cache()
+        sys.exit(0)
+
+    if args.dry_run:
+        if args.together is not None:
+            dry_run(args.together, [part for case in args.cases for part in case_parts(case)])
+        else:
+            for case in args.cases:
+                dry_run(case, case_parts(case))
+        sys.exit(0)
+
+    if args.together is not None:
+        draw_nested(args.together, [part for case in args.cases for part in case_parts(case)])
+        evict_cache()
+        sys.exit(0)
+
+    if args.batch_pdf is not None:
+        basename = args.batch_pdf[:-4] if args.batch_pdf.endswith(".pdf") else args.batch_pdf
+        start = time.time()
+        layouts = [(case, lay_out(case, case_parts(case))) for case in args.cases]
+        pages = draw_combined(Canvas(), basename, layouts)
+        evict_cache()
+        print("Rendered %s cases (%s pages) into %s.pdf in %.2fs" % (len(layouts), pages, basename, time.time() - start))
+        sys.exit(0)
+
+    start = time.time()
+    results = draw_cases(args.cases, args.jobs, args.threads)
+    elapsed = time.time() - start
+
+    evict_cache()
+
+    if len(results) > 1:
+        for (case, pages, seconds, cached) in results:
+            print("%s: %s pages in %.2fs (%s cached)" % (case, pages, seconds, cached))
+        total_pages = sum(pages for (_, pages, _, _) in results)
+        total_cached = sum(cached for (_, _, _, cached) in results)
+        print("Rendered %s cases (%s pages, %s cached) in %.2fs wall time"
+              % (len(results), total_pages, total_cached, elapsed))